@@ -0,0 +1,158 @@
+"""
+Benchmark of the DeepSearch JSON Parsing
+
+This script times the extraction of the chunks of a DeepSearch document with 20k "main-text" items:
+- concat per row: the former `parse_JSON`, concatenating a one row frame per chunk (quadratic),
+- parse_JSON: the rows collected in a list and built in a single frame
+  (see flows/etl_deepsearch_pdf_parsing.py).
+
+The former implementation is only timed up to `--max-loop-items` items, as it takes minutes beyond,
+and both implementations are checked to return the same chunks.
+
+Usage:
+    python benchmark_deepsearch_parsing.py --items 5000 20000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "flows"))
+
+from etl_chunks_store import CHUNKS_COLUMNS
+from etl_deepsearch_pdf_parsing import parse_JSON
+
+
+def concat_per_row_parse_JSON(data, pd_chunks, file_infos):
+    """
+    The former implementation of parse_JSON (one concat per chunk).
+    """
+
+    min_chunk_size = 5
+
+    last_header = None
+    bloc_text = ""
+    bloc_indexes = []
+    last_index = pd_chunks.shape[0]
+    ext_text = ""
+
+    for item in data.get("main-text", []):
+        if item["name"] == "subtitle-level-1" and item["type"] == "subtitle-level-1":
+            last_header = item["text"]
+
+            if bloc_text != "":
+                pd_chunks.loc[bloc_indexes, "bloc"] = bloc_text
+                bloc_text = ""
+                bloc_indexes = []
+
+        elif item["name"] == "list-item" and item["type"] == "paragraph":
+            ext_text += item["text"]
+            ext_type = "list-item"
+
+        elif item["name"] == "text" and item["type"] == "paragraph":
+            ext_text += item["text"]
+            ext_type = "text"
+
+        if ext_text != "":
+            if len(ext_text) <= min_chunk_size:
+                continue
+
+            bloc_text += "\n" + ext_text
+            bloc_indexes.append(last_index)
+            last_index += 1
+
+            new_row = {
+                "file_hash": file_infos.file_hash,
+                "file_name": file_infos.file_name,
+                "page": item["prov"][0]["page"],
+                "level": None,
+                "type": ext_type,
+                "header": last_header,
+                "chunk": ext_text,
+                "bloc": None,
+            }
+
+            pd_chunks = pd.concat([pd_chunks, pd.DataFrame([new_row])], ignore_index=True)
+            ext_text = ""
+
+    return pd_chunks
+
+
+def random_document(num_items, seed=0):
+    """
+    Returns a DeepSearch document with `num_items` items (subtitles, paragraphs, list items, short texts).
+    """
+
+    rng = random.Random(seed)
+    kinds = [
+        ("subtitle-level-1", "subtitle-level-1"),
+        ("text", "paragraph"),
+        ("list-item", "paragraph"),
+        ("page-header", "page-header"),
+    ]
+
+    items = []
+    for i in range(num_items):
+        name, kind = rng.choices(kinds, weights=[1, 10, 4, 1])[0]
+        length = rng.choice([3, 40, 200, 800])
+        items.append(
+            {
+                "name": name,
+                "type": kind,
+                "text": f"Item {i} " + "x" * length if length > 5 else "xx",
+                "prov": [{"page": 1 + i // 50}],
+            }
+        )
+
+    return {"main-text": items}
+
+
+def timed(function, *args):
+    """
+    Returns the result of a call and its duration, in seconds.
+    """
+
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def get_arguments():
+    """
+    Initialize the argparse module and return the expected arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark of the DeepSearch JSON parsing")
+    parser.add_argument("--items", type=int, nargs="+", default=[2000, 5000, 20000], help="The numbers of main-text items")
+    parser.add_argument("--max-loop-items", type=int, default=5000, help="The maximum number of items for the former implementation")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+    file_infos = pd.Series({"file_hash": "0123456789abcdef", "file_name": "benchmark.pdf"})
+
+    print(f"{'items':>8} {'chunks':>8} {'concat per row':>15} {'parse_JSON':>11}  (seconds)")
+
+    for num_items in args.items:
+        data = random_document(num_items)
+
+        # The Prefect task is called as a plain function
+        chunks, one_frame = timed(parse_JSON.fn, data, file_infos)
+
+        loop = "-"
+        if num_items <= args.max_loop_items:
+            expected, duration = timed(
+                concat_per_row_parse_JSON, data, pd.DataFrame(columns=CHUNKS_COLUMNS), file_infos
+            )
+            loop = f"{duration:.2f}"
+
+            pd.testing.assert_frame_equal(
+                chunks.astype(object), expected.loc[:, CHUNKS_COLUMNS].astype(object)
+            )
+
+        print(f"{num_items:>8} {len(chunks):>8} {loop:>15} {one_frame:>11.3f}")
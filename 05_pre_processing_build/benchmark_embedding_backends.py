@@ -0,0 +1,88 @@
+"""
+Benchmark of the Embedding Backends
+
+This script compares the torch backend (full precision) and the ONNX backend (int8) of an embedding
+model on CPU (see flows/etl_embedding_models.py): loading time, throughput (texts per second),
+peak memory (RSS) and parity of the embeddings (cosine similarity).
+
+Each backend is measured in its own process, so that the peak memory of one doesn't include the other.
+The ONNX export is done (and cached) before the measures, so the ONNX process doesn't load the torch model.
+
+Usage:
+    python benchmark_embedding_backends.py --num-texts 2000
+    python benchmark_embedding_backends.py --chunks data/extracted_chunks.csv
+"""
+import os
+import sys
+import time
+import resource
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "flows"))
+
+from etl_embedding_models import EMBEDDING_MODEL, check_parity, get_model, prepare_onnx
+
+from benchmark_embedding_workers import load_texts, synthetic_texts
+
+
+def measure(texts, model_name, backend, batch_size):
+    """
+    Loads the model and encodes the texts with the given backend, then prints the measures.
+    """
+
+    start = time.perf_counter()
+    model = get_model(model_name, "cpu", warm_up=True, backend=backend)
+    loading = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+    encoding = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{backend:>8} {loading:>8.2f} {len(texts) / encoding:>10.1f} {max_rss:>12.0f}")
+
+
+def get_arguments():
+    """
+    Initialize the argparse module and return the expected arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark of the embedding backends")
+    parser.add_argument("--chunks", default=None, help="A chunks CSV file (synthetic texts by default)")
+    parser.add_argument("--num-texts", type=int, default=2000, help="The number of texts to encode")
+    parser.add_argument("--batch-size", type=int, default=32, help="The number of texts encoded together")
+    parser.add_argument("--model", default=EMBEDDING_MODEL, help="The SentenceTransformer model")
+    parser.add_argument("--backend", default=None, help="Measure this backend only, in this process")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+
+    if args.chunks is not None:
+        texts = load_texts(args.chunks, args.num_texts)
+    else:
+        texts = synthetic_texts(args.num_texts)
+
+    if args.backend is not None:
+        measure(texts, args.model, args.backend, args.batch_size)
+        sys.exit(0)
+
+    # Export and quantize the model once, outside of the measures
+    prepare_onnx(args.model)
+
+    print(f"{len(texts)} texts, batch size {args.batch_size}, model {args.model} (cpu)", flush=True)
+    print(f"{'backend':>8} {'load s':>8} {'texts/s':>10} {'max RSS MB':>12}", flush=True)
+
+    for backend in ["torch", "onnx"]:
+        command = [sys.executable, __file__, "--backend", backend]
+        command += ["--num-texts", str(args.num_texts), "--batch-size", str(args.batch_size)]
+        command += ["--model", args.model]
+        if args.chunks is not None:
+            command += ["--chunks", args.chunks]
+        subprocess.run(command, check=True)
+
+    check_parity(texts[:500], args.model, threshold=0.0)
@@ -0,0 +1,95 @@
+"""
+Benchmark of the Encoding Pool
+
+This script measures the throughput of the chunk embeddings (texts per second) with 1, 2, 4 and 8
+encoding processes (see get_pool in flows/etl_embedding_models.py).
+
+The texts are the chunks of the given CSV file (e.g. data/extracted_chunks.csv), or synthetic texts
+of various lengths. The pools are started and warmed up before being timed.
+
+Usage:
+    python benchmark_embedding_workers.py --num-texts 5000
+    python benchmark_embedding_workers.py --chunks data/extracted_chunks.csv --workers 1 2 4
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "flows"))
+
+from etl_embedding_models import EMBEDDING_MODEL, encode_texts, get_pool
+
+
+WORDS = (
+    "digital compact internet connectivity data protection human rights artificial intelligence "
+    "governance inclusion cooperation open source standards trust security privacy access skills"
+).split()
+
+
+def synthetic_texts(num_texts, seed=0):
+    """
+    Returns random texts of 5 to 200 words.
+    """
+
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 200)))
+        for _ in range(num_texts)
+    ]
+
+
+def load_texts(chunks_path, num_texts):
+    """
+    Returns the first chunks of the CSV file.
+    """
+
+    import pandas as pd
+
+    chunks = pd.read_csv(chunks_path, usecols=["chunk"]).dropna()
+    return chunks["chunk"].astype(str).tolist()[:num_texts]
+
+
+def get_arguments():
+    """
+    Initialize the argparse module and return the expected arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark of the encoding pool")
+    parser.add_argument("--chunks", default=None, help="A chunks CSV file (synthetic texts by default)")
+    parser.add_argument("--num-texts", type=int, default=2000, help="The number of texts to encode")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="The numbers of workers to compare")
+    parser.add_argument("--batch-size", type=int, default=32, help="The number of texts encoded together")
+    parser.add_argument("--model", default=EMBEDDING_MODEL, help="The SentenceTransformer model")
+    parser.add_argument("--backend", default="torch", help="The inference backend, torch or onnx")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+
+    if args.chunks is not None:
+        texts = load_texts(args.chunks, args.num_texts)
+    else:
+        texts = synthetic_texts(args.num_texts)
+
+    print(f"{len(texts)} texts, batch size {args.batch_size}, model {args.model} ({args.backend}, cpu)")
+    print(f"{'workers':>8} {'seconds':>10} {'texts/s':>10} {'speedup':>8}")
+
+    baseline = None
+    for num_workers in args.workers:
+        # Start the pool (spawn and model loading) and warm it up outside of the timing
+        if num_workers > 1:
+            get_pool(args.model, "cpu", num_workers, args.backend)
+        warm_up = texts[: args.batch_size * max(num_workers, 1) + 1]
+        encode_texts(warm_up, args.model, "cpu", args.batch_size, num_workers, args.backend)
+
+        start = time.perf_counter()
+        encode_texts(texts, args.model, "cpu", args.batch_size, num_workers, args.backend)
+        elapsed = time.perf_counter() - start
+
+        throughput = len(texts) / elapsed
+        baseline = baseline or throughput
+        print(f"{num_workers:>8} {elapsed:>10.2f} {throughput:>10.1f} {throughput / baseline:>7.2f}x")
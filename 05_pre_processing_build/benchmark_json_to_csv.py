@@ -0,0 +1,115 @@
+"""
+Benchmark of the PowerBI JSON to CSV Conversion
+
+This script times the conversion of Power BI rows (DSR) to a DataFrame, for 10k to 100k rows:
+- loc append: the former `to_dataframe`, appending the rows one by one with `.loc` (quadratic),
+- to_dataframe: the rows built in a single DataFrame call (see flows/json_to_csv.py),
+- extract: the whole conversion of a payload (decoding of the bitsets and dictionaries included).
+
+The former implementation is only timed up to `--max-loop-rows` rows, as it takes minutes beyond.
+
+Usage:
+    python benchmark_json_to_csv.py --rows 10000 50000 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "flows"))
+
+from json_to_csv import extract, to_dataframe
+
+
+WIDTH = 8
+COLUMNS = [f"Column {i}" for i in range(WIDTH)]
+
+
+def loc_append_to_dataframe(columns, dm0):
+    """
+    The former implementation of to_dataframe (one .loc append per row).
+    """
+
+    data = pd.DataFrame({}, columns=columns)
+    for item in dm0:
+        data.loc[len(data)] = item["C"]
+
+    return data
+
+
+def random_payload(num_rows, seed=0):
+    """
+    Returns a Power BI query response with `num_rows` rows (half of the columns use a dictionary).
+    """
+
+    rng = random.Random(seed)
+    columns_types = [{"N": f"G{i}", "DN": f"D{i}"} if i % 2 else {"N": f"G{i}"} for i in range(WIDTH)]
+    value_dicts = {f"D{i}": [f"Value {i}.{j}" for j in range(50)] for i in range(1, WIDTH, 2)}
+
+    dm0 = []
+    for row in range(num_rows):
+        copy_bitset = 0 if row == 0 else rng.getrandbits(WIDTH) & rng.getrandbits(WIDTH)
+        values = [
+            rng.randrange(50) if i % 2 else f"Text {rng.randrange(10**6)}\nline"
+            for i in range(WIDTH)
+            if not (copy_bitset >> i) & 1
+        ]
+        dm0.append({"C": values, "R": copy_bitset} if copy_bitset else {"C": values})
+    dm0[0]["S"] = columns_types
+
+    return {
+        "results": [
+            {
+                "result": {
+                    "data": {
+                        "descriptor": {"Select": [{"Kind": 2, "Value": c} for c in COLUMNS]},
+                        "dsr": {"DS": [{"PH": [{"DM0": dm0}], "ValueDicts": value_dicts}]},
+                    }
+                }
+            }
+        ]
+    }
+
+
+def timed(function, *args):
+    """
+    Returns the duration of a call, in seconds.
+    """
+
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def get_arguments():
+    """
+    Initialize the argparse module and return the expected arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark of the PowerBI JSON to CSV conversion")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 25000, 50000, 100000], help="The numbers of rows")
+    parser.add_argument("--max-loop-rows", type=int, default=10000, help="The maximum number of rows for the former implementation")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+
+    print(f"{'rows':>8} {'loc append':>12} {'to_dataframe':>13} {'extract':>10}  (seconds)")
+
+    for num_rows in args.rows:
+        payload = random_payload(num_rows)
+        rows = [{"C": [f"Text {i}"] * WIDTH} for i in range(num_rows)]
+
+        loop = "-"
+        if num_rows <= args.max_loop_rows:
+            loop = f"{timed(loc_append_to_dataframe, COLUMNS, rows):.2f}"
+
+        one_call = timed(to_dataframe, COLUMNS, rows)
+        full = timed(extract, payload)
+
+        print(f"{num_rows:>8} {loop:>12} {one_call:>13.3f} {full:>10.3f}")
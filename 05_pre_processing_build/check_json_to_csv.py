@@ -0,0 +1,225 @@
+"""
+PowerBI JSON to CSV Check
+
+This script checks that `extract` (single pass decoding, see flows/json_to_csv.py) writes the same CSV
+as the baseline implementation (reconstruct_arrays, expand_values, replace_newlines_with, then the rows
+appended one by one with `.loc`), byte for byte, on Power BI payloads:
+- recorded: the responses recorded by the scraping flow (data/cache/powerbi/*.json.gz, see ResponseCache),
+- random: generated payloads covering the "R" (copy previous value) and "Ø" (null value) bitsets,
+  the dictionary columns, the newlines in the values and the columns sharing the same name.
+  They mix numbers and nulls in a way the recorded responses don't: the `.loc` append of the baseline
+  converts the integers of some rows to floats (e.g. a row holding only numbers and nulls), while
+  `extract` keeps the decoded values. So this mode compares the decoding only, the baseline rows
+  being built in a single frame.
+
+Usage:
+    python check_json_to_csv.py --recorded data/cache/powerbi
+    python check_json_to_csv.py --num-payloads 3000
+"""
+import os
+import sys
+import copy
+import random
+import argparse
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "flows"))
+
+from etl_cache import read_json_gz
+from json_to_csv import expand_values, extract, reconstruct_arrays, replace_newlines_with
+
+
+NAMES = ["Type", "Entity Name", "Location", "Record ID", "Topic"]
+STRINGS = ["Government", "Civil society", "Private\nsector", "Academia", "", "Line 1\nLine 2\n"]
+
+
+def random_value(rng):
+    """
+    Returns a random plain value (string, number or null).
+    """
+
+    return rng.choice([rng.choice(STRINGS), rng.randint(0, 10**6), rng.random(), None])
+
+
+def random_payload(rng, num_rows):
+    """
+    Returns a random Power BI query response with `num_rows` rows.
+
+    Parameters:
+    - rng (random.Random): The random generator.
+    - num_rows (int): The number of rows of the payload.
+
+    Returns:
+    dict: The JSON payload.
+    """
+
+    width = rng.randint(1, 6)
+    num_groups = rng.randint(0, width)
+
+    # Columns names drawn from a small pool, so some of them are repeated
+    select = [
+        {"Kind": 1, "GroupKeys": [{"Source": {"Property": rng.choice(NAMES)}}]}
+        for _ in range(num_groups)
+    ] + [{"Kind": 2, "Value": rng.choice(NAMES)} for _ in range(width - num_groups)]
+
+    columns_types = []
+    value_dicts = {}
+    for i in range(width):
+        column_type = {"N": f"G{i}"}
+        if rng.random() < 0.5:
+            column_type["DN"] = f"D{i}"
+            value_dicts[f"D{i}"] = [rng.choice(STRINGS) + str(j) for j in range(rng.randint(1, 8))]
+        columns_types.append(column_type)
+
+    dm0 = []
+    for row in range(num_rows):
+        # The first row can't copy the values of a previous one
+        copy_bitset = 0 if row == 0 else rng.getrandbits(width) & rng.getrandbits(width)
+        delete_bitset = rng.getrandbits(width) & rng.getrandbits(width) & ~copy_bitset
+
+        values = []
+        for i, column_type in enumerate(columns_types):
+            if (copy_bitset >> i) & 1 or (delete_bitset >> i) & 1:
+                continue
+            if "DN" in column_type:
+                # The integers of the dictionary columns are indexes of their dictionary
+                if rng.random() < 0.9:
+                    values.append(rng.randrange(len(value_dicts[column_type["DN"]])))
+                else:
+                    values.append(rng.choice([rng.choice(STRINGS), None]))
+            else:
+                values.append(random_value(rng))
+
+        item = {"C": values}
+        if copy_bitset or rng.random() < 0.1:
+            item["R"] = copy_bitset
+        if delete_bitset or rng.random() < 0.1:
+            item["Ø"] = delete_bitset
+        dm0.append(item)
+
+    if num_rows > 0:
+        dm0[0]["S"] = columns_types
+
+    return {
+        "results": [
+            {
+                "result": {
+                    "data": {
+                        "descriptor": {"Select": select},
+                        "dsr": {"DS": [{"PH": [{"DM0": dm0}], "ValueDicts": value_dicts}]},
+                    }
+                }
+            }
+        ]
+    }
+
+
+def baseline_extract(input_json, loc_append=True):
+    """
+    Converts the payload with the baseline implementation of `extract` (on a copy, it mutates the data).
+    Without `loc_append`, the decoded rows are built in a single frame instead of being appended one by one.
+    """
+
+    data = copy.deepcopy(input_json)["results"][0]["result"]["data"]
+    dm0 = data["dsr"]["DS"][0]["PH"][0]["DM0"]
+    columns_types = dm0[0]["S"]
+    columns = [
+        item["GroupKeys"][0]["Source"]["Property"]
+        for item in data["descriptor"]["Select"]
+        if item["Kind"] == 1
+    ]
+    columns += [item["Value"] for item in data["descriptor"]["Select"] if item["Kind"] == 2]
+    value_dicts = data["dsr"]["DS"][0].get("ValueDicts", {})
+
+    reconstruct_arrays(columns_types, dm0)
+    expand_values(columns_types, dm0, value_dicts)
+    replace_newlines_with(dm0, "")
+
+    if not loc_append:
+        return pd.DataFrame([item["C"] for item in dm0], columns=columns, dtype=object)
+
+    data = pd.DataFrame({}, columns=columns)
+    for item in dm0:
+        data.loc[len(data)] = item["C"]
+
+    return data
+
+
+def recorded_payloads(paths):
+    """
+    Yields the name and content of the recorded responses found in the given files or folders.
+    """
+
+    for path in paths:
+        names = [path]
+        if os.path.isdir(path):
+            names = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+
+        for name in names:
+            if name.endswith(".json.gz"):
+                yield name, read_json_gz(name)
+
+
+def has_rows(payload):
+    """
+    Returns whether a response contains rows to convert (the last page of a query may not).
+    """
+
+    try:
+        return len(payload["results"][0]["result"]["data"]["dsr"]["DS"][0]["PH"][0].get("DM0", [])) > 0
+    except (KeyError, IndexError, TypeError):
+        return False
+
+
+def check(name, payload, loc_append=True):
+    """
+    Raises an exception if extract doesn't write the same CSV as the baseline, or modifies its input.
+    """
+
+    original = copy.deepcopy(payload)
+
+    expected = baseline_extract(payload, loc_append).to_csv(index=False)
+    actual = extract(payload).to_csv(index=False)
+
+    if payload != original:
+        raise Exception(f"{name}: extract modified its input")
+    if actual != expected:
+        raise Exception(f"{name}: the CSV differs\n--- expected\n{expected}\n--- actual\n{actual}")
+
+
+def get_arguments():
+    """
+    Initialize the argparse module and return the expected arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Compares extract with the former implementation")
+    parser.add_argument("--recorded", nargs="+", default=None, help="Recorded responses (files or folders) to replay instead of random payloads")
+    parser.add_argument("--num-payloads", type=int, default=3000, help="The number of random payloads")
+    parser.add_argument("--max-rows", type=int, default=50, help="The maximum number of rows per payload")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the random generator")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+
+    if args.recorded is not None:
+        num_payloads = 0
+        for name, payload in recorded_payloads(args.recorded):
+            if has_rows(payload):
+                check(name, payload)
+                num_payloads += 1
+
+        if num_payloads == 0:
+            raise Exception(f"No recorded response with rows found in {args.recorded}")
+
+        print(f"{num_payloads} recorded responses: identical CSV")
+
+    else:
+        rng = random.Random(args.seed)
+        for n in range(args.num_payloads):
+            check(f"Payload {n}", random_payload(rng, rng.randint(1, args.max_rows)), loc_append=False)
+
+        print(f"{args.num_payloads} random payloads: identical CSV")
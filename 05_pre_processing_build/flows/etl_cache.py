@@ -0,0 +1,514 @@
+"""
+On-disk Caches
+
+This module defines the on-disk caches used by the ETL flows.
+The cached values are JSON documents, stored gzip-compressed under a content-addressed key.
+
+Classes:
+- ResponseCache: Cache of HTTP JSON responses keyed by a canonical hash of the request,
+  with a time-to-live and a size-bounded LRU eviction. It can also replay the recorded
+  responses without any network access (offline mode).
+- ParseCache: Cache of the raw outputs of a PDF parser keyed by file hash and parser version,
+  so the chunks can be rebuilt without parsing the files again.
+- EmbeddingCache: Cache of the embeddings of a model keyed by the hash of the normalized text,
+  stored as a memory-mapped float32 matrix and an index file.
+
+Functions:
+- canonical_hash: Computes the SHA-256 hash of the canonical JSON form of a value.
+- parser_version: Returns the installed version of a parser package.
+- text_hash: Computes the SHA-256 hash of a normalized text.
+"""
+import os
+import gzip
+import json
+import time
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+from importlib import metadata
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+
+def canonical_hash(value: Any) -> str:
+    """
+    Computes the SHA-256 hash of the canonical JSON form of a value (sorted keys, no whitespace).
+
+    Parameters:
+    - value (Any): The JSON serializable value.
+
+    Returns:
+    str: The hexadecimal representation of the hash.
+    """
+
+    canonical = json.dumps(
+        value, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def read_json_gz(path: Path) -> Any:
+    """
+    Reads a gzip-compressed JSON file.
+    """
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json_gz(path: Path, value: Any) -> None:
+    """
+    Writes a gzip-compressed JSON file atomically (through a temporary file).
+    """
+
+    tmp_path = Path(f"{path}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(value, f)
+
+    os.replace(tmp_path, path)
+
+
+class ResponseCache:
+    """
+    Cache of HTTP JSON responses stored on disk.
+
+    Entries expire `ttl` seconds after they were written, and the least recently used entries
+    are evicted when the cache grows over `max_size` bytes. In offline mode, the entries never
+    expire and a missing entry is an error, so a flow can be replayed from recorded responses.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        ttl: Optional[float] = 3600,
+        max_size: int = 512 * 1024 * 1024,
+        offline: bool = False,
+    ) -> None:
+        """
+        Parameters:
+        - path (Path): The cache folder (created if it doesn't exist).
+        - ttl (Optional[float]): The lifetime of the entries in seconds (None: no expiration).
+        - max_size (int): The maximum size of the cache on disk, in bytes.
+        - offline (bool): Whether the cache must answer every request (replay mode).
+        """
+
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self._lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, url: str, payload: Any) -> str:
+        """
+        Computes the cache key of a request.
+
+        Parameters:
+        - url (str): The URL of the request.
+        - payload (Any): The JSON payload of the request.
+
+        Returns:
+        str: The cache key.
+        """
+
+        return canonical_hash({"url": url, "payload": payload})
+
+    def entry_path(self, key: str) -> Path:
+        return Path(self.path, f"{key}.json.gz")
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns the cached response for the given key, or None if it is missing or expired.
+
+        Parameters:
+        - key (str): The cache key.
+
+        Returns:
+        Optional[Any]: The cached response.
+        """
+
+        path = self.entry_path(key)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if self.offline:
+                raise Exception(f"No recorded response for {key} (offline mode)")
+            return None
+
+        now = time.time()
+        if not self.offline and self.ttl is not None and now - stat.st_mtime > self.ttl:
+            return None
+
+        # The access time keeps track of the last use (for the LRU eviction)
+        os.utime(path, (now, stat.st_mtime))
+        return read_json_gz(path)
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Stores a response in the cache, then evicts the least recently used entries if needed.
+
+        Parameters:
+        - key (str): The cache key.
+        - value (Any): The JSON response.
+
+        Returns:
+        None
+        """
+
+        write_json_gz(self.entry_path(key), value)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits in `max_size`.
+        """
+
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".json.gz"):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+
+            size = sum(entry[1] for entry in entries)
+            for _, entry_size, entry_path in sorted(entries):
+                if size <= self.max_size:
+                    break
+
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+
+
+def parser_version(package: str) -> str:
+    """
+    Returns the installed version of a parser package ("unknown" if it can't be found).
+
+    Parameters:
+    - package (str): The name of the package (e.g. "llmsherpa").
+
+    Returns:
+    str: The version of the package.
+    """
+
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+class ParseCache:
+    """
+    Cache of the raw outputs of a PDF parser stored on disk.
+
+    The entries are keyed by the hash of the parsed file, under a folder per parser and parser version,
+    so a new version of the parser never reuses the outputs of the previous one.
+    The entries never expire (the parsed files are identified by their content).
+    """
+
+    def __init__(self, path: Path, parser: str, version: Optional[str] = None) -> None:
+        """
+        Parameters:
+        - path (Path): The cache folder (created if it doesn't exist).
+        - parser (str): The name of the parser package (e.g. "llmsherpa", "deepsearch-toolkit").
+        - version (Optional[str]): The version of the parser (the installed version by default).
+        """
+
+        self.parser = parser
+        self.version = version or parser_version(parser)
+        self.path = Path(path, parser, self.version)
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry_path(self, file_hash: Any) -> Path:
+        return Path(self.path, f"{file_hash}.json.gz")
+
+    def __contains__(self, file_hash: Any) -> bool:
+        return os.path.exists(self.entry_path(file_hash))
+
+    def file_hashes(self) -> List[str]:
+        """
+        Returns the hashes of the files having a cached output.
+        """
+
+        return [
+            name[: -len(".json.gz")]
+            for name in sorted(os.listdir(self.path))
+            if name.endswith(".json.gz")
+        ]
+
+    def get(self, file_hash: Any) -> Optional[Any]:
+        """
+        Returns the cached output of the parser for the given file, or None if it is missing.
+
+        Parameters:
+        - file_hash (Any): The hash of the parsed file.
+
+        Returns:
+        Optional[Any]: The raw output of the parser.
+        """
+
+        try:
+            return read_json_gz(self.entry_path(file_hash))
+        except FileNotFoundError:
+            return None
+
+    def put(self, file_hash: Any, value: Any) -> None:
+        """
+        Stores the raw output of the parser for the given file.
+
+        Parameters:
+        - file_hash (Any): The hash of the parsed file.
+        - value (Any): The raw output of the parser.
+
+        Returns:
+        None
+        """
+
+        write_json_gz(self.entry_path(file_hash), value)
+
+
+def text_hash(text: str) -> str:
+    """
+    Computes the SHA-256 hash of a text, normalized by collapsing the whitespaces.
+
+    Parameters:
+    - text (str): The text.
+
+    Returns:
+    str: The hexadecimal representation of the hash.
+    """
+
+    normalized = " ".join(str(text).split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache of the embeddings computed by a model, stored on disk.
+
+    The vectors are appended to a float32 matrix (`vectors.f32`, read as a memory map) and their keys
+    to an index file (`index.txt`, one key per line, in the order of the matrix rows).
+    The dimension of the vectors is stored in `meta.json`.
+    The entries are keyed by the hash of the normalized text (see text_hash), under a folder per model.
+
+    Several instances (threads, processes or flows) can share the same folder: the writes are serialized
+    by a lock file (`.lock`), and each instance reloads the index written by the others before appending.
+    """
+
+    def __init__(self, path: Path, model_name: str) -> None:
+        """
+        Parameters:
+        - path (Path): The cache folder (created if it doesn't exist).
+        - model_name (str): The name of the embedding model.
+        """
+
+        self.model_name = model_name
+        self.path = Path(path, model_name.replace("/", "__"))
+        self.vectors_path = Path(self.path, "vectors.f32")
+        self.index_path = Path(self.path, "index.txt")
+        self.meta_path = Path(self.path, "meta.json")
+        self.lock_path = Path(self.path, ".lock")
+        self._lock = threading.Lock()
+        self._rows: Dict[str, int] = {}
+        self._dim: Optional[int] = None
+        self._vectors: Optional[np.memmap] = None
+        self._index_size = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.reload()
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reload(self) -> None:
+        """
+        Reloads the cache from its files (e.g. after they were downloaded from AWS-S3).
+        """
+
+        with self._lock, self._file_lock():
+            self._load()
+
+    def _load(self) -> None:
+        # Must be called with the file lock held (it truncates the interrupted writes)
+        self._rows = {}
+        self._vectors = None
+        self._index_size = 0
+
+        if not os.path.exists(self.meta_path):
+            return
+
+        with open(self.meta_path, "r") as f:
+            self._dim = json.load(f)["dim"]
+
+        index = ""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                index = f.read()
+        keys = index.split()
+
+        # The last key of an interrupted write isn't followed by a newline
+        if len(index) > 0 and not index.endswith("\n"):
+            keys = keys[:-1]
+
+        # The vectors are written before their keys, drop the vectors and keys of an interrupted write
+        row_size = 4 * self._dim
+        if os.path.exists(self.vectors_path):
+            num_rows = min(len(keys), os.path.getsize(self.vectors_path) // row_size)
+            os.truncate(self.vectors_path, num_rows * row_size)
+        else:
+            num_rows = 0
+
+        if num_rows < len(keys) or not index.endswith("\n"):
+            index = "".join(f"{key}\n" for key in keys[:num_rows])
+            with open(self.index_path, "w") as f:
+                f.write(index)
+
+        self._rows = {key: row for row, key in enumerate(keys[:num_rows])}
+        self._index_size = len(index)
+
+    def _is_stale(self) -> bool:
+        # The index grew (or was created) since it was loaded: another instance appended to it
+        if not os.path.exists(self.meta_path):
+            return False
+        if self._dim is None:
+            return True
+
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        return index_size != self._index_size
+
+    def _matrix(self) -> np.memmap:
+        num_rows = len(self._rows)
+        if self._vectors is None or self._vectors.shape[0] != num_rows:
+            self._vectors = np.memmap(
+                self.vectors_path, dtype=np.float32, mode="r", shape=(num_rows, self._dim)
+            )
+
+        return self._vectors
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Returns the cached vectors of the given keys.
+
+        Parameters:
+        - keys (List[str]): The keys (hashes of the texts).
+
+        Returns:
+        Dict[str, np.ndarray]: The vectors found in the cache, by key.
+        """
+
+        with self._lock:
+            rows = {key: self._rows[key] for key in keys if key in self._rows}
+            if len(rows) == 0:
+                return {}
+
+            matrix = self._matrix()
+            return {key: np.array(matrix[row]) for key, row in rows.items()}
+
+    def put_many(self, keys: List[str], vectors: np.ndarray) -> None:
+        """
+        Appends vectors to the cache (the keys already cached are skipped).
+
+        The rows of the new vectors are taken from the shared files, after reloading the entries
+        appended by the other instances.
+
+        Parameters:
+        - keys (List[str]): The keys (hashes of the texts).
+        - vectors (np.ndarray): The vectors, one row per key.
+
+        Returns:
+        None
+        """
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        with self._lock, self._file_lock():
+            if self._is_stale():
+                self._load()
+
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                with open(self.meta_path, "w") as f:
+                    json.dump({"model_name": self.model_name, "dim": self._dim}, f)
+            elif vectors.shape[1] != self._dim:
+                raise Exception(
+                    f"The embeddings of {self.model_name} have {self._dim} dimensions, not {vectors.shape[1]}"
+                )
+
+            new_keys = {}
+            for row, key in enumerate(keys):
+                if key not in self._rows and key not in new_keys:
+                    new_keys[key] = row
+
+            if len(new_keys) == 0:
+                return
+
+            row_size = 4 * self._dim
+            start = 0
+            if os.path.exists(self.vectors_path):
+                start = os.path.getsize(self.vectors_path) // row_size
+
+            index = "".join(f"{key}\n" for key in new_keys)
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors[list(new_keys.values())].tobytes())
+            with open(self.index_path, "a") as f:
+                f.write(index)
+            self._index_size += len(index)
+
+            for row, key in enumerate(new_keys, start):
+                self._rows[key] = row
+
+    @staticmethod
+    def index_entries(index_path: Path) -> int:
+        """
+        Returns the number of complete entries of an index file (0 if it doesn't exist).
+        """
+
+        if not os.path.exists(index_path):
+            return 0
+
+        with open(index_path, "r") as f:
+            return f.read().count("\n")
+
+    def update_from(self, path: Path) -> bool:
+        """
+        Replaces the files of the cache with those of another copy (e.g. downloaded from AWS-S3),
+        unless the local index holds at least as many entries, so the newer local entries are kept.
+
+        Parameters:
+        - path (Path): The folder of the other copy (its files are moved).
+
+        Returns:
+        bool: Whether the files of the cache were replaced.
+        """
+
+        names = ["meta.json", "vectors.f32", "index.txt"]
+
+        with self._lock, self._file_lock():
+            if any(not os.path.exists(Path(path, name)) for name in names):
+                return False
+            if self.index_entries(Path(path, "index.txt")) <= self.index_entries(self.index_path):
+                return False
+
+            # The index is moved last, like it is written last by put_many
+            for name in names:
+                os.replace(Path(path, name), Path(self.path, name))
+            self._load()
+
+        return True
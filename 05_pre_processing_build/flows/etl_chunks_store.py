@@ -0,0 +1,322 @@
+"""
+Chunks Store
+
+This module defines the storage of the chunks extracted from the collected files.
+The chunks are shared by the parsing flows (which write them) and the embedding flows (which read them).
+
+Classes:
+- CSVChunksStore: Stores all the chunks in a single `extracted_chunks.csv` file.
+- ParquetChunksStore: Stores the chunks in one Parquet file per `file_hash`, so the flows can read
+  only the columns and files they need, and upload only the files that changed.
+
+Functions:
+- open_chunks_store: Downloads (if needed) and opens the chunks store of the selected backend.
+  The Parquet files are downloaded from AWS-S3 only when their chunks are loaded.
+
+Note: Ensure that the 'pyarrow' package is installed to use the Parquet backend.
+"""
+import os
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import pandas as pd
+from prefect_aws import S3Bucket
+
+from etl_common import download_AWS_object
+
+
+CHUNKS_COLUMNS = [
+    "file_hash",
+    "file_name",
+    "page",
+    "level",
+    "type",
+    "header",
+    "chunk",
+    "bloc",
+]
+
+# Columns of the chunks needed by the embedding flows (the blocs are not used)
+EMBEDDING_COLUMNS = ["file_hash", "file_name", "page", "level", "type", "header", "chunk"]
+
+CHUNKS_BACKENDS = {
+    "csv": "extracted_chunks.csv",
+    "parquet": "extracted_chunks",
+}
+
+
+def empty_chunks() -> pd.DataFrame:
+    """
+    Creates an empty chunks dataframe.
+
+    Returns:
+    pd.DataFrame: The empty dataframe with the chunks columns.
+    """
+
+    return pd.DataFrame(columns=CHUNKS_COLUMNS)
+
+
+class CSVChunksStore:
+    """
+    Chunks store backed by a single CSV file, loaded in full and rewritten in full.
+    """
+
+    def __init__(self, path: Path) -> None:
+        """
+        Parameters:
+        - path (Path): The CSV file (it doesn't need to exist yet).
+        """
+
+        self.path = path
+        self._data: Optional[pd.DataFrame] = None
+        self._pending: List[pd.DataFrame] = []
+
+    def _frame(self) -> pd.DataFrame:
+        if self._data is None:
+            if os.path.exists(self.path):
+                self._data = pd.read_csv(self.path)
+                self._data["file_hash"] = self._data["file_hash"].astype(str)
+            else:
+                self._data = empty_chunks()
+
+        if self._pending:
+            new_chunks = pd.concat(self._pending, ignore_index=True)
+            replaced = self._data["file_hash"].isin(new_chunks["file_hash"])
+            self._data = pd.concat(
+                [self._data[~replaced], new_chunks], ignore_index=True
+            )
+            self._pending = []
+
+        return self._data
+
+    def load(
+        self,
+        columns: Optional[List[str]] = None,
+        file_hashes: Optional[Iterable[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Loads the chunks.
+
+        Parameters:
+        - columns (Optional[List[str]]): The columns to load (all of them by default).
+        - file_hashes (Optional[Iterable[str]]): The files to load the chunks of (all of them by default).
+
+        Returns:
+        pd.DataFrame: The selected chunks.
+        """
+
+        data = self._frame()
+
+        if file_hashes is not None:
+            data = data[data["file_hash"].isin([str(h) for h in file_hashes])]
+        if columns is not None:
+            data = data.loc[:, columns]
+
+        return data.copy()
+
+    def put(self, chunks: pd.DataFrame) -> None:
+        """
+        Replaces the chunks of the files present in the given dataframe.
+
+        Parameters:
+        - chunks (pd.DataFrame): The new chunks of one or several files.
+
+        Returns:
+        None
+        """
+
+        chunks = chunks.astype({"file_hash": str})
+        self._pending.append(chunks)
+
+    def save(self) -> List[Path]:
+        """
+        Writes the chunks to the CSV file.
+
+        Returns:
+        List[Path]: The files written (to upload to AWS-S3).
+        """
+
+        if self._data is None and not self._pending:
+            return []
+
+        self._frame().to_csv(self.path, index=False)
+        return [self.path]
+
+
+class ParquetChunksStore:
+    """
+    Chunks store backed by one Parquet file per `file_hash`.
+
+    The files are written as soon as they are put in the store, and only those are uploaded on save.
+    When a bucket is given, the files missing locally are downloaded from AWS-S3 when they are loaded.
+    """
+
+    def __init__(self, path: Path, bucket_block: Optional[S3Bucket] = None) -> None:
+        """
+        Parameters:
+        - path (Path): The folder of the Parquet files (created if it doesn't exist).
+        - bucket_block (Optional[S3Bucket]): The AWS-S3 bucket holding the Parquet files of the previous runs.
+        """
+
+        self.path = path
+        self.bucket_block = bucket_block
+        self._changed: List[Path] = []
+        self._remote_file_hashes: Optional[List[str]] = None
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def partition_path(self, file_hash: str) -> Path:
+        """
+        Returns the path of the Parquet file holding the chunks of the given file.
+        """
+
+        return Path(self.path, f"{file_hash}.parquet")
+
+    def file_hashes(self) -> List[str]:
+        """
+        Returns the hashes of the files having chunks in the store (locally or on AWS-S3).
+        """
+
+        local_file_hashes = [
+            name[: -len(".parquet")]
+            for name in os.listdir(self.path)
+            if name.endswith(".parquet")
+        ]
+
+        return sorted(set(local_file_hashes) | set(self.remote_file_hashes()))
+
+    def remote_file_hashes(self) -> List[str]:
+        """
+        Returns the hashes of the files having chunks on AWS-S3 (listed once).
+        """
+
+        if self.bucket_block is None:
+            return []
+
+        if self._remote_file_hashes is None:
+            try:
+                objects = self.bucket_block.list_objects(folder=str(self.path))
+            except Exception as e:
+                print(e, self.path)
+                objects = []
+
+            self._remote_file_hashes = [
+                os.path.basename(o["Key"])[: -len(".parquet")]
+                for o in objects
+                if o["Key"].endswith(".parquet")
+            ]
+
+        return self._remote_file_hashes
+
+    def load(
+        self,
+        columns: Optional[List[str]] = None,
+        file_hashes: Optional[Iterable[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Loads the chunks, reading only the requested columns of the requested files.
+
+        Parameters:
+        - columns (Optional[List[str]]): The columns to load (all of them by default).
+        - file_hashes (Optional[Iterable[str]]): The files to load the chunks of (all of them by default).
+
+        Returns:
+        pd.DataFrame: The selected chunks.
+        """
+
+        if file_hashes is None:
+            file_hashes = self.file_hashes()
+
+        paths = [self.partition_path(str(h)) for h in file_hashes]
+
+        # Download only the requested files that aren't available locally
+        remote_file_hashes = set(self.remote_file_hashes())
+        for file_hash, path in zip(file_hashes, paths):
+            if not os.path.exists(path) and str(file_hash) in remote_file_hashes:
+                download_AWS_object(path, path, self.bucket_block)
+        frames = [
+            pd.read_parquet(path, columns=columns)
+            for path in paths
+            if os.path.exists(path)
+        ]
+
+        if len(frames) == 0:
+            return empty_chunks().loc[:, columns or CHUNKS_COLUMNS]
+
+        chunks = pd.concat(frames, ignore_index=True)
+
+        # Parquet returns the missing values as None, the CSV backend as NaN
+        return chunks.where(chunks.notna(), float("nan"))
+
+    def put(self, chunks: pd.DataFrame) -> None:
+        """
+        Replaces the chunks of the files present in the given dataframe.
+
+        Parameters:
+        - chunks (pd.DataFrame): The new chunks of one or several files.
+
+        Returns:
+        None
+        """
+
+        chunks = chunks.astype({"file_hash": str})
+
+        for file_hash, file_chunks in chunks.groupby("file_hash", sort=False):
+            path = self.partition_path(file_hash)
+            file_chunks.to_parquet(path, index=False)
+
+            if path not in self._changed:
+                self._changed.append(path)
+
+    def save(self) -> List[Path]:
+        """
+        Returns the files written since the store was opened (they are written on `put`).
+
+        Returns:
+        List[Path]: The files written (to upload to AWS-S3).
+        """
+
+        changed, self._changed = self._changed, []
+        return changed
+
+
+def open_chunks_store(
+    local_dir: Union[str, Path], bucket_block: S3Bucket, backend: str = "csv"
+) -> Union[CSVChunksStore, ParquetChunksStore]:
+    """
+    Downloads the chunks from AWS-S3 if they aren't available locally, and opens the store.
+
+    Parameters:
+    - local_dir (Union[str, Path]): The local directory of the chunks.
+    - bucket_block (S3Bucket): The Prefect S3Bucket object representing the AWS-S3 bucket.
+    - backend (str): The chunks backend, "csv" or "parquet".
+      The Parquet store is initialized from the CSV file the first time it is used.
+
+    Returns:
+    Union[CSVChunksStore, ParquetChunksStore]: The opened store.
+    """
+
+    if backend not in CHUNKS_BACKENDS:
+        raise Exception(f"Unknown chunks backend: {backend}")
+
+    csv_path = Path(local_dir, CHUNKS_BACKENDS["csv"])
+    path = Path(local_dir, CHUNKS_BACKENDS[backend])
+
+    if backend == "csv":
+        if not os.path.exists(path):
+            download_AWS_object(path, path, bucket_block)
+        return CSVChunksStore(path)
+
+    # The Parquet files are downloaded when they are loaded, only those needed by the flow
+    chunks_store = ParquetChunksStore(path, bucket_block)
+
+    is_new = len(chunks_store.file_hashes()) == 0
+
+    if is_new:
+        if not os.path.exists(csv_path):
+            download_AWS_object(csv_path, csv_path, bucket_block)
+        if os.path.exists(csv_path):
+            print(f"Import {csv_path} into {path}")
+            chunks_store.put(CSVChunksStore(csv_path).load())
+
+    return chunks_store
@@ -5,21 +5,31 @@ This module defines various common utility functions for the ETL pipeline.
 
 Functions:
 - read_AWS: Downloads a remote file from AWS-S3 to a local folder.
+- download_AWS_object: Downloads a remote file from AWS-S3, even if it doesn't exist locally yet.
+- download_embedding_cache: Downloads the embedding cache from AWS-S3 if it holds more entries than the local one.
 - write_AWS: Uploads a local file to AWS-S3.
+- create_session: Creates an HTTP session sized for the given number of concurrent workers.
 - get_arguments: Initialize the argparse module and return the expected arguments
   ...
 
-Note: Ensure that the 'prefect' and 'prefect_aws' packages are installed for proper execution.
+Note: Ensure that the 'requests', 'prefect' and 'prefect_aws' packages are installed for proper execution.
 """
 import os
 import argparse
+import tempfile
 from datetime import timedelta
+from pathlib import Path
+from typing import Dict, Optional
 
 import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
 
 from prefect import flow, task
 from prefect_aws import S3Bucket
 
+from etl_cache import EmbeddingCache
+
 # from prefect.tasks import task_input_hash
 
 
@@ -56,6 +66,66 @@ def read_AWS(remote_path: str, local_path: str, bucket_block: S3Bucket) -> None:
         print(e, remote_path)
 
 
+def download_AWS_object(remote_path: str, local_path: str, bucket_block: S3Bucket) -> bool:
+    """
+    Downloads a remote AWS-S3 file to a local path.
+
+    Unlike `read_AWS`, which relies on the local path to tell a file from a folder,
+    it works when the file doesn't exist locally yet (e.g. in a fresh container).
+
+    Parameters:
+    - remote_path (str): The path to the remote file on AWS-S3.
+    - local_path (str): The path to the local file.
+    - bucket_block (S3Bucket): The Prefect S3Bucket object representing the AWS-S3 bucket.
+
+    Returns:
+    bool: Whether the file was downloaded (False if it doesn't exist on AWS-S3).
+    """
+    try:
+        print("Download from S3:", remote_path, ">", local_path)
+        bucket_block.download_object_to_path(
+            from_path=str(remote_path), to_path=str(local_path)
+        )
+        return True
+
+    except Exception as e:
+        print(e, remote_path)
+        return False
+
+
+def download_embedding_cache(embedding_cache: EmbeddingCache, bucket_block: S3Bucket) -> int:
+    """
+    Downloads the embedding cache from AWS-S3, unless the local index holds at least as many entries
+    as the remote one (the remote index is downloaded first to compare them).
+
+    Parameters:
+    - embedding_cache (EmbeddingCache): The local embedding cache.
+    - bucket_block (S3Bucket): The Prefect S3Bucket object representing the AWS-S3 bucket.
+
+    Returns:
+    int: The number of entries of the cache on AWS-S3 (0 if it doesn't exist), to upload the cache
+    only if the local one holds more.
+    """
+
+    # The files are downloaded next to the cache folder (not in it, as the folder is uploaded)
+    with tempfile.TemporaryDirectory(dir=embedding_cache.path.parent) as remote_dir:
+        remote_index_path = Path(remote_dir, "index.txt")
+        if not download_AWS_object(embedding_cache.index_path, remote_index_path, bucket_block):
+            return 0
+
+        remote_entries = EmbeddingCache.index_entries(remote_index_path)
+        if remote_entries <= EmbeddingCache.index_entries(embedding_cache.index_path):
+            print(f"The local embedding cache is up to date ({remote_entries} entries on AWS-S3)")
+            return remote_entries
+
+        for path in [embedding_cache.meta_path, embedding_cache.vectors_path]:
+            if not download_AWS_object(path, Path(remote_dir, path.name), bucket_block):
+                return remote_entries
+
+        embedding_cache.update_from(Path(remote_dir))
+        return remote_entries
+
+
 @task(
     name="Write Data on AWS-S3",
     log_prints=True,
@@ -89,6 +159,31 @@ def write_AWS(local_path: str, remote_path: str, bucket_block: S3Bucket) -> None
         print(e, local_path)
 
 
+def create_session(
+    max_workers: int = 1, headers: Optional[Dict[str, str]] = None
+) -> requests.Session:
+    """
+    Creates an HTTP session sized for the given number of concurrent workers.
+
+    Parameters:
+    - max_workers (int): The number of threads that will share the session.
+    - headers (Optional[Dict[str, str]]): The default headers of the requests.
+
+    Returns:
+    requests.Session: The session, with a connection pool per worker.
+    """
+
+    session = requests.Session()
+    if headers is not None:
+        session.headers.update(headers)
+
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
 def get_arguments() -> str:
     """
     Initialize the argparse module and return the expected arguments.
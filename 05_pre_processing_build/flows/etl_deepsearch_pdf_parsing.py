@@ -8,14 +8,19 @@ The flow includes tasks for parsing PDF, extracting JSON from ZIP, and parsing J
 
 Tasks:
 - Parse PDF: Utilizes the IBM DeepSearch API to convert PDF documents and download them locally.
-- Extract JSON from ZIP: Extracts JSON files from ZIP archives generated by the DeepSearch process.
-- Parse JSON: Processes JSON files to extract relevant information.
+  The documents are submitted in batches, converted concurrently in per-batch directories.
+- Parse JSON: Processes the DeepSearch JSON documents to extract relevant information.
+  The documents are cached by file hash, so the chunks can be rebuilt without converting the files again.
+
+Functions:
+- convert_batch: Converts a batch of PDF documents with a single DeepSearch submission.
+- extract_json: Extracts the JSON documents from the ZIP archives generated by the DeepSearch process.
 
 Prefect Flow:
 - omdena_ungdc_etl_pdf_parsing_parent: Orchestrates the PDF parsing process for multiple files.
   - Initializes the DeepSearch API.
   - Retrieves a list of files to process from an AWS S3 bucket.
-  - Parses each PDF, extracts JSON, and processes the information.
+  - Converts the PDF files by batches, extracts JSON, and processes the information.
   - Updates a file tracking CSV with parsing status.
   - Writes the updated CSV back to the AWS S3 bucket.
 
@@ -24,114 +29,186 @@ Note: Ensure that the 'deepsearch', 'prefect', and 'prefect_aws' packages are in
 
 import os
 import json
+import shutil
 import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Union, Any, List, Dict
+from typing import Optional, Union, Any, List, Dict, Tuple
 
 import pandas as pd
 import deepsearch as ds
 from deepsearch.cps.client.api import CpsApi
 
 from prefect import flow, task
+from prefect.utilities.annotations import quote
 from prefect_aws import S3Bucket
 
 from etl_common import read_AWS, write_AWS, get_arguments
+from etl_cache import ParseCache
+from etl_chunks_store import CHUNKS_COLUMNS, open_chunks_store
+from etl_files_tracker import open_files_tracker
 # from flows.preprocessing.metadata_extractors import example_summary_extractor
 
 
-@task(name="Parse PDF", log_prints=True)
-def parse_PDF(
+def extract_json(result_dir: Path) -> Dict[str, Dict[str, Any]]:
+    """
+    Extracts the JSON documents from the ZIP archives of a result directory.
+
+    The JSON documents are decoded directly from the ZIP members, without writing them to disk.
+
+    Parameters:
+    - result_dir (Path): Directory containing ZIP archives.
+
+    Returns:
+    Dict[str, Dict[str, Any]]: The extracted JSON documents, by name of the source file (without extension).
+    """
+
+    documents = {}
+    print("Extract from", result_dir)
+    for document in os.listdir(result_dir):
+        if document.endswith(".zip"):
+            zip_file_path = Path(result_dir, document)
+            with zipfile.ZipFile(zip_file_path, "r") as z:
+                for filename in z.namelist():
+                    if filename.endswith(".json"):
+                        with z.open(filename) as f:
+                            documents[Path(filename).stem] = json.load(f)
+
+            os.remove(zip_file_path)
+
+    return documents
+
+
+def convert_batch(
     api: CpsApi,
     proj_key: str,
-    local_dir: str,
-    file_path: Path,
-    file_infos: pd.DataFrame,
-) -> None:
+    work_dir: Path,
+    files: List[Tuple[Path, str]],
+) -> Dict[str, Dict[str, Any]]:
     """
-    Task to parse PDF documents using IBM DeepSearch.
+    Converts a batch of PDF documents with a single IBM DeepSearch submission.
+
+    The batch gets its own directories (source files and results), so its results can't be mixed up
+    with those of another batch. The source files are named after their hash, so two files with the
+    same name can't overwrite each other, and the results are mapped back by hash.
 
     Parameters:
     - api (CpsApi): IBM DeepSearch API object.
     - proj_key (str): Project key for DeepSearch.
-    - local_dir (str): Local directory to store downloaded documents.
-    - file_path (Path): Path to the PDF file to be parsed.
-    - file_infos (pd.DataFrame): Information about the file being processed.
+    - work_dir (Path): Local directory where the batch directories are created.
+    - files (List[Tuple[Path, str]]): The path and hash of the PDF files to be converted.
 
     Returns:
-    None
+    Dict[str, Dict[str, Any]]: The DeepSearch JSON documents, by hash of the source file.
     """
 
-    print(f"ETL | PDF parsing | Task: DeepSearch with {file_path}")
+    batch_dir = Path(tempfile.mkdtemp(prefix="batch_", dir=work_dir))
+    source_dir = Path(batch_dir, "source")
+    result_dir = Path(batch_dir, "result")
+    os.makedirs(source_dir)
+    os.makedirs(result_dir)
+
+    try:
+        for file_path, file_hash in files:
+            target_path = Path(source_dir, f"{file_hash}{Path(file_path).suffix}")
+            try:
+                os.link(file_path, target_path)
+            except OSError:
+                shutil.copyfile(file_path, target_path)
 
-    documents = ds.convert_documents(api=api, proj_key=proj_key, source_path=file_path)
-    documents.download_all(result_dir=local_dir)
+        documents = ds.convert_documents(api=api, proj_key=proj_key, source_path=source_dir)
+        documents.download_all(result_dir=result_dir)
 
+        return extract_json(result_dir)
 
-@task(name="Extract JSON from ZIP", log_prints=True)
-def extract_json(result_dir: str) -> Path:
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+@task(name="Parse PDF", log_prints=True)
+def parse_PDF(
+    api: CpsApi,
+    proj_key: str,
+    local_dir: str,
+    files: List[Tuple[Path, str]],
+    parse_cache: ParseCache,
+    batch_size: int = 10,
+    max_workers: int = 2,
+) -> List[str]:
     """
-    Task to extract JSON files from ZIP archives.
+    Task to parse PDF documents using IBM DeepSearch.
+
+    The documents are submitted in batches, and several batches are converted concurrently.
+    The converted documents are stored in the parse cache as soon as their batch is done.
 
     Parameters:
-    - result_dir (str): Directory containing ZIP archives.
+    - api (CpsApi): IBM DeepSearch API object.
+    - proj_key (str): Project key for DeepSearch.
+    - local_dir (str): Local directory to store downloaded documents.
+    - files (List[Tuple[Path, str]]): The path and hash of the PDF files to be parsed.
+    - parse_cache (ParseCache): The cache of the DeepSearch documents.
+    - batch_size (int): The number of documents per conversion.
+    - max_workers (int): The maximum number of conversions running concurrently.
 
     Returns:
-    Path: Path to the extracted JSON file.
+    List[str]: The hashes of the files successfully converted.
     """
 
-    print("ETL | PDF parsing | Task: Extracting JSON from Zip")
+    work_dir = Path(local_dir, "deepsearch")
+    os.makedirs(work_dir, exist_ok=True)
+
+    batch_size = max(1, batch_size)
+    batches = [files[i : i + batch_size] for i in range(0, len(files), batch_size)]
+
+    def convert(batch: List[Tuple[Path, str]]) -> List[str]:
+        print(f"ETL | PDF parsing | Task: DeepSearch with {[str(f) for f, _ in batch]}")
+        try:
+            documents = convert_batch(api, proj_key, work_dir, batch)
+        except Exception as e:
+            print(f"A problem occured with the DeepSearch conversion of {len(batch)} documents: \n{e}")
+            return []
+
+        converted = []
+        for file_path, file_hash in batch:
+            data = documents.get(str(file_hash))
+            if data is None:
+                print(f"No DeepSearch document was returned for {file_path}")
+                continue
 
-    json_file_path = None
-    print("Extract from", result_dir)
-    for document in os.listdir(result_dir):
-        if document.endswith(".zip"):
-            print(document)
+            parse_cache.put(file_hash, data)
+            converted.append(file_hash)
 
-            zip_file_path = Path(result_dir, document)
-            with zipfile.ZipFile(zip_file_path, "r") as z:
-                for filename in z.namelist():
-                    if filename.endswith(".json"):
-                        print(filename)
+        return converted
 
-                        with z.open(filename) as f:
-                            data = json.loads(f.read().decode("utf-8"))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = list(executor.map(convert, batches))
 
-                            json_file_path = Path(result_dir, filename)
-                            with open(json_file_path, "w") as f:
-                                json.dump(data, f, indent=4)
-
-            os.remove(zip_file_path)
-
-    return json_file_path
+    return [file_hash for converted in results for file_hash in converted]
 
 
 @task(name="Parse JSON", log_prints=True)
-def parse_JSON(
-    file_path: Path, pd_chunks: pd.DataFrame, file_infos: pd.DataFrame
-) -> None:
+def parse_JSON(data: Dict[str, Any], file_infos: pd.DataFrame) -> pd.DataFrame:
     """
-    Task to parse information from JSON files.
+    Task to parse information from DeepSearch JSON documents.
 
     Parameters:
-    - file_path (Path): Path to the JSON file to be parsed.
-    - pd_chunks (pd.DataFrame): The pandas dataframe to store the extracted infos.
+    - data (Dict[str, Any]): The DeepSearch JSON document.
     - file_infos (pd.DataFrame): The source file informations.
 
     Returns:
-    pd.DataFrame: The modified pandas dataframe.
+    pd.DataFrame: The chunks extracted from the document.
     """
 
-    print(f"ETL | PDF parsing | Task: Extracting infos from JSON {file_path}")
+    print(f"ETL | PDF parsing | Task: Extracting infos from JSON of {file_infos.file_name}")
 
     min_chunk_size = 5
 
-    with open(file_path, "r") as file:
-        data = json.load(file)
-
+    rows = []
+    blocs = []
     last_header = None
     bloc_text = ""
-    bloc_indexes = []
-    last_index = pd_chunks.shape[0]
+    bloc_start = 0
     ext_text = ""
     # summary = example_summary_extractor()
 
@@ -139,10 +216,11 @@ def parse_JSON(
         if item["name"] == "subtitle-level-1" and item["type"] == "subtitle-level-1":
             last_header = item["text"]
 
+            # The rows added since the previous subtitle share the same bloc
             if bloc_text != "":
-                pd_chunks.loc[bloc_indexes, "bloc"] = bloc_text
+                blocs[bloc_start:] = [bloc_text] * (len(rows) - bloc_start)
                 bloc_text = ""
-                bloc_indexes = []
+                bloc_start = len(rows)
 
         elif item["name"] == "list-item" and item["type"] == "paragraph":
             ext_text += item["text"]
@@ -157,38 +235,50 @@ def parse_JSON(
                 continue
 
             bloc_text += "\n" + ext_text
-            bloc_indexes.append(last_index)
-            last_index += 1
-
-            new_row = {
-                "file_hash": file_infos.file_hash,
-                "file_name": file_infos.file_name,
-                "page": item["prov"][0]["page"],
-                "level": None,
-                "type": ext_type,
-                "header": last_header,
-                "chunk": ext_text,
-                "bloc": Noneœ,
-                # **summary
-            }
-
-            pd_chunks = pd.concat(
-                [pd_chunks, pd.DataFrame([new_row])], ignore_index=True
+
+            rows.append(
+                (
+                    item["prov"][0]["page"],
+                    ext_type,
+                    last_header,
+                    ext_text,
+                    # **summary
+                )
             )
+            blocs.append(None)
             ext_text = ""
 
-    # pd_chunks.loc[bloc_indexes, "bloc"] = bloc_text # ⚠️  deactivated to reduce the size of the CSV
+    # blocs[bloc_start:] = [bloc_text] * (len(rows) - bloc_start) # ⚠️  deactivated to reduce the size of the CSV
 
-    return pd_chunks
+    pd_chunks = pd.DataFrame(rows, columns=["page", "type", "header", "chunk"])
+    pd_chunks.insert(0, "file_hash", file_infos.file_hash)
+    pd_chunks.insert(1, "file_name", file_infos.file_name)
+    pd_chunks.insert(3, "level", None)
+    pd_chunks["bloc"] = blocs
+
+    return pd_chunks.loc[:, CHUNKS_COLUMNS]
 
 
 @flow(log_prints=True)
-def omdena_ungdc_etl_pdf_parsing_parent(max_doc: int = None) -> None:
+def omdena_ungdc_etl_pdf_parsing_parent(
+    max_doc: int = None,
+    tracker_backend: str = "csv",
+    chunks_backend: str = "csv",
+    rebuild: bool = False,
+    batch_size: int = 10,
+    max_workers: int = 2,
+) -> None:
     """
     Prefect flow for orchestrating PDF parsing using IBM DeepSearch.
 
     Parameters:
     - max_doc (int): The maximum number of documents to process
+    - tracker_backend (str): The files tracker backend, "csv" or "sqlite"
+    - chunks_backend (str): The chunks store backend, "csv" or "parquet"
+    - rebuild (bool): Whether to rebuild the chunks of the already parsed files from the cached documents
+      (the cache is synced with AWS-S3: the new documents are uploaded, and downloaded to rebuild)
+    - batch_size (int): The number of documents per DeepSearch conversion
+    - max_workers (int): The maximum number of DeepSearch conversions running concurrently
 
     Returns:
     None
@@ -196,10 +286,6 @@ def omdena_ungdc_etl_pdf_parsing_parent(max_doc: int = None) -> None:
 
     print("ETL | PDF parsing")
 
-    # Define IBM DeepSearch access
-    api = CpsApi.from_env()
-    proj_key = api.projects.list()[0].key
-
     # Get the list of files to ingest
     bucket_block = S3Bucket.load("omdena-un-gdc-bucket")
 
@@ -207,50 +293,33 @@ def omdena_ungdc_etl_pdf_parsing_parent(max_doc: int = None) -> None:
     if not os.path.exists(local_dir):
         raise Exception("The source folder doesn't exist")
 
-    files_tracker_path = Path(local_dir, "files_tracker.csv")
-    if not os.path.exists(files_tracker_path):
-        read_AWS(files_tracker_path, files_tracker_path, bucket_block)
-    files_tracker = pd.read_csv(files_tracker_path)
-
-    # Define the file to save the chunks
-    pd_chunk_path = Path(local_dir, "extracted_chunks.csv")
-    if not os.path.exists(pd_chunk_path):
-        read_AWS(pd_chunk_path, pd_chunk_path, bucket_block)
-
-    if os.path.exists(pd_chunk_path):
-        pd_chunks = pd.read_csv(pd_chunk_path)
-    else:
-        columns = [
-            "file_hash",
-            "file_name",
-            "page",
-            "level",
-            "type",
-            "header",
-            "chunk",
-            "bloc",
-            # "summary"
-        ]
-        pd_chunks = pd.DataFrame(columns=columns)
-
-    # Parse the collected files
-    i = 0
-    for file in files_tracker.itertuples():
-        if file.present_in_last_update is True and file.parsed is False:  # ⚠️
-            file_path = Path(local_dir, file.file_name)
-
-            # Parse PDF using IBM DeepSearch
-            parse_PDF(api, proj_key, local_dir, file_path, file)
-
-            # Extract the JSON file from the returned DeepSearch Zip
-            json_file_path = extract_json(local_dir)
+    files_tracker = open_files_tracker(local_dir, bucket_block, tracker_backend)
 
-            # Extract interesting information from JSON file
-            pd_chunks = parse_JSON(json_file_path, pd_chunks, file)
+    # Define the store to save the chunks
+    chunks_store = open_chunks_store(local_dir, bucket_block, chunks_backend)
 
-            # Update the files_tracker
-            files_tracker.at[file.Index, "parsed"] = True
+    # Define the cache of the DeepSearch documents
+    parse_cache = ParseCache(Path(local_dir, "cache", "parsed"), "deepsearch-toolkit")
+    if rebuild:
+        read_AWS(parse_cache.path, parse_cache.path, bucket_block)
 
+    # Select the files to parse (or to rebuild)
+    parsed_files = []
+    rebuilt_files = []
+    i = 0
+    for file in files_tracker.itertuples():
+        if file.present_in_last_update is True and file.parsed is False:  # ⚠️
+            parsed_files.append(file)
+        elif (
+            rebuild
+            and file.present_in_last_update is True
+            and not str(file.file_name).startswith("PowerBI_")
+        ):
+            # Only the present PDF files can have a DeepSearch document in the cache
+            if file.file_hash in parse_cache:
+                rebuilt_files.append(file)
+            else:
+                print(f"{file.file_name} can't be rebuilt, its DeepSearch document isn't in the cache")
         else:
             print(f"The last version of {file.file_name} has already been parsed")
 
@@ -258,11 +327,55 @@ def omdena_ungdc_etl_pdf_parsing_parent(max_doc: int = None) -> None:
         if max_doc is not None and i >= max_doc:
             break
 
-    pd_chunks.to_csv(pd_chunk_path, index=False)
-
-    files_tracker.to_csv(files_tracker_path, index=False)
-    write_AWS(files_tracker_path, files_tracker_path, bucket_block)
-    write_AWS(pd_chunks, pd_chunks, bucket_block)
+    # Parse the PDF files missing from the cache using IBM DeepSearch
+    converted_files = [
+        (Path(local_dir, file.file_name), file.file_hash)
+        for file in parsed_files
+        if file.file_hash not in parse_cache
+    ]
+    if len(converted_files) > 0:
+        # Define IBM DeepSearch access
+        api = CpsApi.from_env()
+        proj_key = api.projects.list()[0].key
+
+        parse_PDF(
+            api,
+            proj_key,
+            local_dir,
+            converted_files,
+            quote(parse_cache),
+            batch_size,
+            max_workers,
+        )
+
+    docs_chunks = []
+    for file in parsed_files:
+        data = parse_cache.get(file.file_hash)
+        if data is None:
+            print(f"A problem occured with PDF parsing on document {file.file_name}")
+            continue
+
+        # Extract interesting information from JSON file
+        docs_chunks.append(parse_JSON(data, file))
+
+        # Update the files_tracker and upload the DeepSearch document
+        files_tracker.set(file.Index, "parsed", True)
+        entry_path = parse_cache.entry_path(file.file_hash)
+        write_AWS(entry_path, entry_path, bucket_block)
+
+    for file in rebuilt_files:
+        # Rebuild the chunks from the cached DeepSearch document, they must be embedded and indexed again
+        docs_chunks.append(parse_JSON(parse_cache.get(file.file_hash), file))
+        files_tracker.set(file.Index, "embedded", False)
+        files_tracker.set(file.Index, "indexed", False)
+
+    if len(docs_chunks) > 0:
+        chunks_store.put(pd.concat(docs_chunks, ignore_index=True))
+
+    files_tracker.save()
+    write_AWS(files_tracker.path, files_tracker.path, bucket_block)
+    for path in chunks_store.save():
+        write_AWS(path, path, bucket_block)
 
 
 if __name__ == "__main__":
@@ -9,6 +9,7 @@ ChromaDB, and performing a query for testing.
 
 Tasks:
 - Embed chunks: Utilizes SentenceTransformer to embed document chunks.
+  The model is loaded once per process (see etl_embedding_models), with PyTorch or ONNX Runtime.
 - Insert in VectorDatabase: Inserts embedded data into ChromaDB.
 - Query Test: Performs a query test on the inserted data.
 
@@ -24,6 +25,7 @@ are installed for proper execution.
 
 import os
 from pathlib import Path
+from typing import Optional
 
 import pandas as pd
 
@@ -31,32 +33,55 @@ from prefect import flow, task
 from prefect_aws import S3Bucket
 from prefect.utilities.annotations import quote
 
-from etl_common import read_AWS, write_AWS, get_arguments
+from etl_common import read_AWS, write_AWS, download_embedding_cache, get_arguments
+from etl_chunks_store import EMBEDDING_COLUMNS, open_chunks_store
+from etl_files_tracker import open_files_tracker
+from etl_embedding_models import (
+    EMBEDDING_MODEL,
+    check_parity,
+    encode,
+    get_model,
+    onnx_model_path,
+)
+from etl_cache import EmbeddingCache
 
 import chromadb
-from chromadb.utils import embedding_functions
-
 
 @task(name="Embed chunks", log_prints=True)
-def embed_chunks(data: list) -> list:
+def embed_chunks(
+    data: list,
+    embed_model: str = EMBEDDING_MODEL,
+    device: Optional[str] = None,
+    batch_size: int = 32,
+    cache: Optional[EmbeddingCache] = None,
+    num_workers: int = 1,
+    backend: str = "torch",
+) -> list:
     """
     Task to embed document chunks using SentenceTransformer.
+    The model is loaded once per process and shared by all the calls.
+
+    SentenceTransformer sorts the chunks by length before splitting them into batches of `batch_size`,
+    so the chunks of several files can be embedded in a single call with little padding.
 
     Parameters:
     - data (list): List of document chunks.
+    - embed_model (str): The name of the SentenceTransformer model.
+    - device (Optional[str]): The device of the model (the best one available by default).
+    - batch_size (int): The number of chunks encoded together.
+    - cache (Optional[EmbeddingCache]): The cache of the embeddings (only the new texts are encoded).
+    - num_workers (int): The number of encoding processes (1: encode in the current process).
+    - backend (str): The inference backend, "torch" or "onnx" (int8 quantized, CPU only).
 
     Returns:
     list: List of embeddings.
     """
 
-    embed_model = "all-MiniLM-L6-v2"
     documents = data["chunk"].values.tolist()
 
-    embedding_func = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name=embed_model
+    embeddings = encode(
+        documents, embed_model, device, batch_size, cache, num_workers, backend
     )
-
-    embeddings = embedding_func(documents)
     # print("EMBEDDING:", embeddings[:5])
 
     return embeddings
@@ -97,9 +122,18 @@ def populate_vectordb(collection: "Collection", embeddings: list, data: list):
     print(collection.count())  # returns the number of items in the collection
 
 
-def query_test(collection: "Collection"):
+def query_test(
+    collection: "Collection",
+    embed_model: str = EMBEDDING_MODEL,
+    device: Optional[str] = None,
+    backend: str = "torch",
+):
+    # Embed the query with the model of the chunks (not with the default embedding function of ChromaDB)
+    query_embeddings = encode(
+        ["Tell me about sustainability by design"], embed_model, device, backend=backend
+    )
     query_results = collection.query(
-        query_texts=["Tell me about sustainability by design"],
+        query_embeddings=query_embeddings,
         n_results=10,
     )
 
@@ -122,12 +156,38 @@ def query_test(collection: "Collection"):
 
 
 @flow(log_prints=True)
-def omdena_ungdc_etl_embedding_parent(max_doc: int = None) -> None:
+def omdena_ungdc_etl_embedding_parent(
+    max_doc: int = None,
+    tracker_backend: str = "csv",
+    chunks_backend: str = "csv",
+    embed_model: str = EMBEDDING_MODEL,
+    device: Optional[str] = None,
+    batch_size: int = 32,
+    corpus_batching: bool = False,
+    use_embedding_cache: bool = True,
+    num_workers: int = 1,
+    backend: str = "torch",
+    check_onnx_parity: bool = False,
+    parity_threshold: float = 0.98,
+) -> None:
     """
     Prefect flow for orchestrating document Embedding and Indexing
 
     Parameters:
     - max_doc (int): The maximum number of documents to process
+    - tracker_backend (str): The files tracker backend, "csv" or "sqlite"
+    - chunks_backend (str): The chunks store backend, "csv" or "parquet"
+    - embed_model (str): The name of the SentenceTransformer model
+    - device (Optional[str]): The device of the model, e.g. "cpu" or "cuda" (the best one available by default)
+    - batch_size (int): The number of chunks encoded together
+    - corpus_batching (bool): Whether to embed the chunks of all the pending files together (instead of file by file)
+    - use_embedding_cache (bool): Whether to reuse the embeddings already computed for identical texts
+    - num_workers (int): The number of encoding processes, each with its own replica of the model
+      (1: encode in the flow process)
+    - backend (str): The inference backend, "torch" or "onnx" (the model exported to ONNX and quantized to int8)
+    - check_onnx_parity (bool): Whether to compare the ONNX and torch embeddings of a sample of chunks
+      before using the ONNX backend (the torch model is loaded for the comparison only)
+    - parity_threshold (float): The minimum cosine similarity accepted by the ONNX parity check
 
     Returns:
     None
@@ -142,16 +202,7 @@ def omdena_ungdc_etl_embedding_parent(max_doc: int = None) -> None:
     if not os.path.exists(local_dir):
         raise Exception("The source folder doesn't exist")
 
-    files_tracker_path = Path(local_dir, "files_tracker.csv")
-    if not os.path.exists(files_tracker_path):
-        read_AWS(files_tracker_path, files_tracker_path, bucket_block)
-    files_tracker = pd.read_csv(files_tracker_path)
-
-    # Load the extracted chunks
-    pd_chunk_path = Path(local_dir, "extracted_chunks.csv")
-    if not os.path.exists(pd_chunk_path):
-        read_AWS(pd_chunk_path, pd_chunk_path, bucket_block)
-    data = pd.read_csv(pd_chunk_path)
+    files_tracker = open_files_tracker(local_dir, bucket_block, tracker_backend)
 
     # Get the existing vectordb or create it
     chroma_data_path = Path(local_dir, "chroma_data")
@@ -166,26 +217,89 @@ def omdena_ungdc_etl_embedding_parent(max_doc: int = None) -> None:
         metadata={"hnsw:space": "cosine"},
     )
 
+    # Select the files to embed: the present files whose chunks aren't in the DB or changed since
+    # their indexing (mapped to whether their previous chunks must be deleted)
+    files_to_embed = {}
+    for i, file in enumerate(files_tracker.itertuples()):
+        if max_doc is not None and i >= max_doc:
+            break
+
+        if file.present_in_last_update is True:
+            r = collection.get(where={"file_hash": file.file_hash}, limit=1)
+            if len(r["ids"]) == 0 or file.embedded is False:
+                files_to_embed[file.Index] = len(r["ids"]) > 0
+
+    # Load the extracted chunks of the files to embed only (without the blocs)
+    chunks_store = open_chunks_store(local_dir, bucket_block, chunks_backend)
+    data = chunks_store.load(
+        columns=EMBEDDING_COLUMNS,
+        file_hashes=[
+            file.file_hash
+            for file in files_tracker.itertuples()
+            if file.Index in files_to_embed
+        ],
+    )
+
+    # Get the ONNX export of the model built by the previous runs
+    if backend == "onnx":
+        onnx_path = onnx_model_path(embed_model)
+        os.makedirs(onnx_path, exist_ok=True)
+        read_AWS(onnx_path, onnx_path, bucket_block)
+
+    # Load the embedding model once for all the files (the encoding workers load their own)
+    if num_workers <= 1:
+        get_model(embed_model, device, warm_up=True, backend=backend)
+
+    # Check that the quantized model gives the same embeddings as the original one
+    if backend == "onnx" and check_onnx_parity:
+        sample = data["chunk"].dropna().astype(str).head(64).tolist()
+        if len(sample) > 0:
+            check_parity(sample, embed_model, parity_threshold)
+
+    # Define the cache of the embeddings (shared with the Weaviate flow)
+    embedding_cache = None
+    if use_embedding_cache:
+        # The embeddings of each backend are cached separately
+        cache_name = embed_model if backend == "torch" else f"{embed_model}@{backend}"
+        embedding_cache = EmbeddingCache(Path(local_dir, "cache", "embeddings"), cache_name)
+
+        # Get the embeddings computed by the previous runs
+        remote_entries = download_embedding_cache(embedding_cache, bucket_block)
+
     # Iterate through files and embed the associated chunks
+    pending_files = []
     i = 0
     for file in files_tracker.itertuples():
-        # Check if the chunks of this file are alredy in the DB
-        r = collection.get(where={"file_hash": file.file_hash})
+        if file.Index in files_to_embed:
+            # Replace the chunks of the files to embed again (e.g. chunks rebuilt or modified since their indexing)
+            if files_to_embed[file.Index]:
+                print(f"The chunks of {file.file_name} changed, they are embedded again")
+                collection.delete(where={"file_hash": file.file_hash})
 
-        # Encode and inject them if they are not in the DB
-        if len(r["ids"]) == 0 and file.present_in_last_update is True:
             # Select chunks
-            doc_chunks = data[data["file_hash"] == file.file_hash]
-
-            # Compute embeddings
-            embeddings = embed_chunks(doc_chunks)
-            files_tracker.at[file.Index, "embedded"] = True
-
-            # Insert new embeddings in the VectorDB
-            populate_vectordb(quote(collection), embeddings, doc_chunks)
-            files_tracker.at[file.Index, "indexed"] = True
-
-        else:
+            doc_chunks = data[data["file_hash"] == str(file.file_hash)]
+
+            if corpus_batching:
+                # Embedded with the chunks of the other files below
+                pending_files.append((file, doc_chunks))
+            else:
+                # Compute embeddings
+                embeddings = embed_chunks(
+                    doc_chunks,
+                    embed_model,
+                    device,
+                    batch_size,
+                    quote(embedding_cache),
+                    num_workers,
+                    backend,
+                )
+                files_tracker.set(file.Index, "embedded", True)
+
+                # Insert new embeddings in the VectorDB
+                populate_vectordb(quote(collection), embeddings, doc_chunks)
+                files_tracker.set(file.Index, "indexed", True)
+
+        elif file.present_in_last_update is True:
             print(
                 f"The last version of {file.file_name} has already been embeded and indexed"
             )
@@ -198,15 +312,44 @@ def omdena_ungdc_etl_embedding_parent(max_doc: int = None) -> None:
         if max_doc is not None and i >= max_doc:
             break
 
-    files_tracker.to_csv(files_tracker_path, index=False)
-    write_AWS(files_tracker_path, files_tracker_path, bucket_block)
+    if len(pending_files) > 0:
+        # Compute the embeddings of all the pending files at once
+        corpus_chunks = pd.concat([doc_chunks for _, doc_chunks in pending_files])
+        print(f"Embed {len(corpus_chunks)} chunks of {len(pending_files)} files")
+        embeddings = embed_chunks(
+            corpus_chunks,
+            embed_model,
+            device,
+            batch_size,
+            quote(embedding_cache),
+            num_workers,
+            backend,
+        )
+
+        # Insert the embeddings of each file in the VectorDB
+        start = 0
+        for file, doc_chunks in pending_files:
+            end = start + len(doc_chunks)
+            files_tracker.set(file.Index, "embedded", True)
+
+            populate_vectordb(quote(collection), embeddings[start:end], doc_chunks)
+            files_tracker.set(file.Index, "indexed", True)
+            start = end
+
+    files_tracker.save()
+    write_AWS(files_tracker.path, files_tracker.path, bucket_block)
     write_AWS(chroma_data_path, chroma_data_path, bucket_block)
+    # Upload the cache only if it holds entries missing from AWS-S3
+    if embedding_cache is not None and len(embedding_cache) > remote_entries:
+        write_AWS(embedding_cache.path, embedding_cache.path, bucket_block)
+    if backend == "onnx":
+        write_AWS(onnx_path, onnx_path, bucket_block)
 
     print(
         "Num elements in the DB:", collection.count()
     )  # returns the number of items in the collection
 
-    query_test(collection)
+    query_test(collection, embed_model, device, backend)
 
 
 if __name__ == "__main__":
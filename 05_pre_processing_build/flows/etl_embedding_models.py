@@ -0,0 +1,597 @@
+"""
+Embedding Models
+
+This module defines the process-level registry of the SentenceTransformer models used by the embedding flows.
+Each model is loaded once per process, device and backend, then shared by all the embedding calls.
+
+Backends:
+- torch: The SentenceTransformer model itself (full precision).
+- onnx: The transformer of the model exported to ONNX and quantized to int8 (dynamic quantization),
+  run with ONNX Runtime on CPU. The pooling and normalization of the model are reproduced.
+  The tokenizer and the configuration of the model are exported with it, so the torch model
+  is only loaded to build the export.
+
+Classes:
+- OnnxEncoder: Encodes texts like a SentenceTransformer model, with its quantized ONNX export.
+
+Functions:
+- onnx_model_path: Returns the folder of the ONNX files of a model.
+- export_onnx: Exports a model to ONNX and quantizes it, once (safe across processes).
+- prepare_onnx: Builds the ONNX files of a model if they are missing, without keeping the model loaded.
+- get_model: Returns the model with the given name, device and backend, loading it on first use.
+- get_pool: Returns a pool of worker processes, each holding its own replica of a model.
+- encode: Encodes texts with a model of the registry, reusing the embeddings found in the cache.
+- check_parity: Compares the embeddings of the ONNX backend with those of the torch backend.
+
+Note: Ensure that the 'sentence_transformers' package is installed for proper execution.
+The 'onnxruntime' and 'onnx' packages are only needed by the ONNX backend.
+"""
+import os
+import sys
+import json
+import fcntl
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+from sentence_transformers.models import Pooling
+
+from etl_cache import EmbeddingCache, text_hash
+
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+EMBEDDING_BACKENDS = ["torch", "onnx"]
+
+# Folder of the ONNX exports of the models
+ONNX_MODELS_PATH = Path("data", "cache", "onnx")
+
+_models: Dict[Tuple[str, str, str], Union[SentenceTransformer, "OnnxEncoder"]] = {}
+_models_lock = threading.Lock()
+
+_pools: Dict[Tuple[str, str, str, int], ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+# Model of the current worker process (see get_pool)
+_worker_model: Optional[Tuple[str, str, str]] = None
+
+
+def resolve_device(device: Optional[str] = None) -> str:
+    """
+    Returns the given device, or the best one available ("cuda" or "cpu").
+    """
+
+    if device is not None:
+        return device
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def onnx_model_path(model_name: str) -> Path:
+    """
+    Returns the folder of the ONNX files of a model.
+    """
+
+    return Path(ONNX_MODELS_PATH, model_name.replace("/", "__"))
+
+
+class _LastHiddenState(torch.nn.Module):
+    """
+    Wraps a transformer so that its ONNX export returns the token embeddings only.
+    """
+
+    def __init__(self, transformer: torch.nn.Module) -> None:
+        super().__init__()
+        self.transformer = transformer
+
+    def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+        return self.transformer(*inputs)[0]
+
+
+class OnnxEncoder:
+    """
+    Encodes texts like a SentenceTransformer model (mean pooling, optional normalization),
+    running its transformer exported to ONNX and quantized to int8 with ONNX Runtime.
+
+    The export is done once and stored in `path` (`model.onnx`, `model_int8.onnx`, the tokenizer and the
+    configuration files of the model, see export_onnx). The encoder is built from these files only,
+    without loading the torch model.
+    """
+
+    def __init__(self, model_name: str, path: Path, quantize: bool = True) -> None:
+        """
+        Parameters:
+        - model_name (str): The name of the SentenceTransformer model.
+        - path (Path): The folder of the ONNX files of the model.
+        - quantize (bool): Whether to quantize the weights to int8 (dynamic quantization).
+        """
+
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        onnx_path = export_onnx(model_name, path, quantize)
+
+        with open(Path(path, "modules.json"), "r") as f:
+            modules = json.load(f)
+        with open(Path(path, "sentence_bert_config.json"), "r") as f:
+            config = json.load(f)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(str(path))
+        self.max_seq_length = config["max_seq_length"]
+        self.do_lower_case = config.get("do_lower_case", False)
+        self.normalize = any(module["type"].endswith(".Normalize") for module in modules)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+
+        self.session = onnxruntime.InferenceSession(
+            str(onnx_path),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def encode(
+        self, texts: List[str], batch_size: int = 32, convert_to_numpy: bool = True
+    ) -> np.ndarray:
+        """
+        Encodes texts (same interface as SentenceTransformer.encode).
+
+        Parameters:
+        - texts (List[str]): The texts to encode.
+        - batch_size (int): The number of texts encoded together.
+        - convert_to_numpy (bool): Kept for compatibility, the embeddings are always a numpy array.
+
+        Returns:
+        np.ndarray: The embeddings of the texts, one row per text.
+        """
+
+        # Sort the texts by length to limit the padding, like SentenceTransformer
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = []
+
+        for start in range(0, len(order), batch_size):
+            batch = [texts[i] for i in order[start : start + batch_size]]
+            if self.do_lower_case:
+                batch = [text.lower() for text in batch]
+            inputs = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            token_embeddings = self.session.run(
+                None, {name: inputs[name].astype(np.int64) for name in self.input_names}
+            )[0]
+
+            # Mean pooling over the tokens of each text
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(
+                mask.sum(axis=1), 1e-9, None
+            )
+
+            if self.normalize:
+                embeddings /= np.clip(
+                    np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None
+                )
+
+            vectors.append(embeddings.astype(np.float32))
+
+        if len(vectors) == 0:
+            return np.zeros((0, self.session.get_outputs()[0].shape[-1]), dtype=np.float32)
+
+        sorted_vectors = np.concatenate(vectors)
+        result = np.empty_like(sorted_vectors)
+        result[order] = sorted_vectors
+
+        return result
+
+
+def _export_transformer(model: SentenceTransformer, path: Path) -> None:
+    print(f"Export the transformer to {path}")
+
+    inputs = model.tokenizer(["warm up"], return_tensors="pt")
+    input_names = [
+        name
+        for name in ["input_ids", "attention_mask", "token_type_ids"]
+        if name in inputs
+    ]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    transformer = _LastHiddenState(model[0].auto_model).eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            tuple(inputs[name] for name in input_names),
+            str(path),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+
+
+def _export_config(model: SentenceTransformer, path: Path) -> None:
+    print(f"Export the tokenizer and the configuration of the model to {path}")
+
+    pooling = [module for module in model if isinstance(module, Pooling)]
+    if len(pooling) != 1 or pooling[0].get_pooling_mode_str() != "mean":
+        raise Exception("The ONNX backend only supports models with a mean pooling")
+
+    model.tokenizer.save_pretrained(str(path))
+
+    # Same files as a saved SentenceTransformer model (without the weights)
+    config = {
+        "max_seq_length": model.max_seq_length,
+        "do_lower_case": getattr(model[0], "do_lower_case", False),
+    }
+    modules = [
+        {
+            "idx": i,
+            "name": str(i),
+            "path": "",
+            "type": f"sentence_transformers.models.{type(module).__name__}",
+        }
+        for i, module in enumerate(model)
+    ]
+
+    with open(Path(path, "sentence_bert_config.json"), "w") as f:
+        json.dump(config, f)
+
+    # modules.json is written last, it marks the configuration as complete
+    tmp_path = Path(path, f"modules.{os.getpid()}.tmp.json")
+    with open(tmp_path, "w") as f:
+        json.dump(modules, f)
+    os.replace(tmp_path, Path(path, "modules.json"))
+
+
+def export_onnx(model_name: str, path: Path, quantize: bool = True) -> Path:
+    """
+    Exports the transformer of a model to ONNX (`model.onnx`) and quantizes it to int8 (`model_int8.onnx`),
+    with its tokenizer and configuration files, unless these files already exist.
+
+    The torch model is only loaded if some files are missing. The files are built under a lock file,
+    written to temporary names then renamed, so the processes building the same model wait for each other
+    and never read a half-written file.
+
+    Parameters:
+    - model_name (str): The name of the SentenceTransformer model.
+    - path (Path): The folder of the ONNX files of the model.
+    - quantize (bool): Whether to quantize the weights to int8 (dynamic quantization).
+
+    Returns:
+    Path: The ONNX file to run (quantized or not).
+    """
+
+    os.makedirs(path, exist_ok=True)
+    fp32_path = Path(path, "model.onnx")
+    int8_path = Path(path, "model_int8.onnx")
+    config_path = Path(path, "modules.json")
+    onnx_path = int8_path if quantize else fp32_path
+
+    with open(Path(path, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            model = None
+            if not os.path.exists(fp32_path) or not os.path.exists(config_path):
+                model = SentenceTransformer(model_name, device="cpu")
+
+            if not os.path.exists(config_path):
+                _export_config(model, path)
+
+            if not os.path.exists(fp32_path):
+                tmp_path = Path(path, f"model.{os.getpid()}.tmp.onnx")
+                _export_transformer(model, tmp_path)
+                os.replace(tmp_path, fp32_path)
+
+            if quantize and not os.path.exists(int8_path):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+
+                print(f"Quantize {fp32_path} to int8")
+                tmp_path = Path(path, f"model_int8.{os.getpid()}.tmp.onnx")
+                quantize_dynamic(str(fp32_path), str(tmp_path), weight_type=QuantType.QInt8)
+                os.replace(tmp_path, int8_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return onnx_path
+
+
+def prepare_onnx(model_name: str = EMBEDDING_MODEL) -> None:
+    """
+    Builds the ONNX files of a model if they are missing, without keeping the model loaded
+    (e.g. before starting encoding workers, so they don't all export it).
+
+    Parameters:
+    - model_name (str): The name of the SentenceTransformer model.
+
+    Returns:
+    None
+    """
+
+    export_onnx(model_name, onnx_model_path(model_name))
+
+
+def get_model(
+    model_name: str = EMBEDDING_MODEL,
+    device: Optional[str] = None,
+    warm_up: bool = False,
+    backend: str = "torch",
+) -> Union[SentenceTransformer, OnnxEncoder]:
+    """
+    Returns the SentenceTransformer model with the given name, device and backend, loading it on first use.
+
+    Parameters:
+    - model_name (str): The name of the SentenceTransformer model.
+    - device (Optional[str]): The device of the model (the best one available by default, always "cpu" with ONNX).
+    - warm_up (bool): Whether to run a first encoding when the model is loaded.
+    - backend (str): The inference backend, "torch" or "onnx".
+
+    Returns:
+    Union[SentenceTransformer, OnnxEncoder]: The shared model.
+    """
+
+    if backend not in EMBEDDING_BACKENDS:
+        raise Exception(f"Unknown embedding backend: {backend}")
+
+    if backend == "onnx":
+        device = "cpu"
+
+    key = (model_name, resolve_device(device), backend)
+
+    with _models_lock:
+        if key not in _models:
+            print(f"Load the embedding model {model_name} on {key[1]} ({backend})")
+            if backend == "onnx":
+                # Built from the ONNX export, without the torch model
+                model = OnnxEncoder(model_name, onnx_model_path(model_name))
+            else:
+                model = SentenceTransformer(model_name, device=key[1])
+
+            if warm_up:
+                model.encode(["warm up"])
+
+            _models[key] = model
+
+    return _models[key]
+
+
+def _init_worker(model_name: str, device: str, backend: str, num_threads: int) -> None:
+    """
+    Initializes a worker process of an encoding pool: pins its number of threads and loads its model.
+    """
+
+    global _worker_model
+
+    torch.set_num_threads(num_threads)
+    get_model(model_name, device, backend=backend)
+    _worker_model = (model_name, device, backend)
+
+
+def _encode_batch(args: Tuple[List[str], int]) -> np.ndarray:
+    """
+    Encodes a batch of texts in a worker process of an encoding pool.
+    """
+
+    texts, batch_size = args
+    model_name, device, backend = _worker_model
+    model = get_model(model_name, device, backend=backend)
+
+    return model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+
+
+def _close_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _pools.clear()
+
+
+atexit.register(_close_pools)
+
+
+def get_pool(
+    model_name: str = EMBEDDING_MODEL,
+    device: Optional[str] = None,
+    num_workers: int = 2,
+    backend: str = "torch",
+) -> ProcessPoolExecutor:
+    """
+    Returns a pool of worker processes, each holding its own replica of the model, creating it on first use.
+
+    The workers are spawned (not forked, which isn't safe with torch threads) and share the CPU cores
+    evenly (torch.set_num_threads), so they don't compete for the same cores.
+    The pools are kept for the lifetime of the process. If a worker fails (e.g. its model can't be loaded),
+    the pool is broken and the encoding raises an error instead of waiting for it.
+
+    Parameters:
+    - model_name (str): The name of the SentenceTransformer model.
+    - device (Optional[str]): The device of the models (the best one available by default).
+    - num_workers (int): The number of worker processes.
+    - backend (str): The inference backend, "torch" or "onnx".
+
+    Returns:
+    ProcessPoolExecutor: The encoding pool.
+    """
+
+    key = (model_name, resolve_device(device), backend, num_workers)
+
+    with _pools_lock:
+        if key not in _pools:
+            num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+            print(f"Start {num_workers} encoding workers with {num_threads} threads each")
+
+            # The spawned workers import this module to run _init_worker, and they start with the
+            # sys.path of this process (Prefect removes the flows folder from it once the flow is loaded)
+            flows_dir = os.path.dirname(os.path.abspath(__file__))
+            if flows_dir not in sys.path:
+                sys.path.insert(0, flows_dir)
+
+            # Export the ONNX model once, before the workers load it
+            if backend == "onnx":
+                prepare_onnx(model_name)
+
+            _pools[key] = ProcessPoolExecutor(
+                num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(model_name, key[1], backend, num_threads),
+            )
+
+    return _pools[key]
+
+
+def encode_texts(
+    texts: List[str],
+    model_name: str = EMBEDDING_MODEL,
+    device: Optional[str] = None,
+    batch_size: int = 32,
+    num_workers: int = 1,
+    backend: str = "torch",
+) -> np.ndarray:
+    """
+    Encodes texts with a model of the registry, in the current process or with an encoding pool.
+
+    With several workers, the texts are sorted by length (to limit the padding) and split into
+    batches, which are fed to the workers through the queue of the pool.
+
+    Parameters:
+    - texts (List[str]): The texts to encode.
+    - model_name (str): The name of the SentenceTransformer model.
+    - device (Optional[str]): The device of the model (the best one available by default).
+    - batch_size (int): The number of texts encoded together.
+    - num_workers (int): The number of worker processes (1: encode in the current process).
+    - backend (str): The inference backend, "torch" or "onnx".
+
+    Returns:
+    np.ndarray: The embeddings of the texts, one row per text.
+    """
+
+    if num_workers <= 1 or len(texts) <= batch_size:
+        model = get_model(model_name, device, backend=backend)
+        return model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+
+    pool = get_pool(model_name, device, num_workers, backend)
+
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    batches = [
+        ([texts[i] for i in order[start : start + batch_size]], batch_size)
+        for start in range(0, len(order), batch_size)
+    ]
+
+    try:
+        sorted_vectors = np.concatenate(list(pool.map(_encode_batch, batches)))
+    except BrokenProcessPool:
+        # Drop the broken pool, so the next call starts new workers
+        with _pools_lock:
+            _pools.pop((model_name, resolve_device(device), backend, num_workers), None)
+        raise Exception(f"The encoding workers of {model_name} failed (see their logs)")
+
+    vectors = np.empty_like(sorted_vectors)
+    vectors[order] = sorted_vectors
+
+    return vectors
+
+
+def encode(
+    texts: List[str],
+    model_name: str = EMBEDDING_MODEL,
+    device: Optional[str] = None,
+    batch_size: int = 32,
+    cache: Optional[EmbeddingCache] = None,
+    num_workers: int = 1,
+    backend: str = "torch",
+) -> List[List[float]]:
+    """
+    Encodes texts with a model of the registry.
+
+    When a cache is given, only the texts missing from it are encoded (once each), and their
+    embeddings are added to it.
+
+    Parameters:
+    - texts (List[str]): The texts to encode.
+    - model_name (str): The name of the SentenceTransformer model.
+    - device (Optional[str]): The device of the model (the best one available by default).
+    - batch_size (int): The number of texts encoded together.
+    - cache (Optional[EmbeddingCache]): The cache of the embeddings of the model.
+    - num_workers (int): The number of worker processes (1: encode in the current process).
+    - backend (str): The inference backend, "torch" or "onnx" (the cache must be specific to the backend).
+
+    Returns:
+    List[List[float]]: The embeddings of the texts.
+    """
+
+    if cache is None:
+        return encode_texts(
+            texts, model_name, device, batch_size, num_workers, backend
+        ).tolist()
+
+    keys = [text_hash(text) for text in texts]
+    vectors = cache.get_many(keys)
+
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors:
+            missing.setdefault(key, text)
+
+    print(f"Embeddings: {len(texts) - len(missing)} found in the cache, {len(missing)} to compute")
+
+    if len(missing) > 0:
+        new_vectors = encode_texts(
+            list(missing.values()), model_name, device, batch_size, num_workers, backend
+        )
+        cache.put_many(list(missing), new_vectors)
+        vectors.update(zip(missing, new_vectors))
+
+    return [vectors[key].tolist() for key in keys]
+
+
+def check_parity(
+    texts: List[str],
+    model_name: str = EMBEDDING_MODEL,
+    threshold: float = 0.98,
+) -> float:
+    """
+    Compares the embeddings of the ONNX backend with those of the torch backend (on CPU).
+
+    The torch model is loaded for the comparison only, it isn't kept in the registry.
+
+    Parameters:
+    - texts (List[str]): A sample of the texts to encode.
+    - model_name (str): The name of the SentenceTransformer model.
+    - threshold (float): The minimum cosine similarity accepted between the embeddings of a text.
+
+    Returns:
+    float: The minimum cosine similarity between the embeddings of the two backends.
+    """
+
+    reference_model = SentenceTransformer(model_name, device="cpu")
+    reference = reference_model.encode(texts, convert_to_numpy=True)
+    del reference_model
+
+    quantized = get_model(model_name, backend="onnx").encode(texts)
+
+    similarities = (reference * quantized).sum(axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(quantized, axis=1)
+    )
+    min_similarity = float(similarities.min())
+    print(
+        f"ONNX parity on {len(texts)} texts: min cosine similarity {min_similarity:.4f}, "
+        f"mean {float(similarities.mean()):.4f}"
+    )
+
+    if min_similarity < threshold:
+        raise Exception(
+            f"The ONNX backend diverges from the torch model ({min_similarity:.4f} < {threshold})"
+        )
+
+    return min_similarity
@@ -27,9 +27,9 @@ None
 import os
 import json
 from pathlib import Path
+from typing import List, Optional, Union
 
 import numpy as np
-import pandas as pd
 
 from prefect import flow, task
 from prefect_aws import S3Bucket
@@ -37,13 +37,21 @@ from prefect.utilities.annotations import quote
 
 import weaviate
 
-from etl_common import read_AWS, write_AWS, get_arguments
+from etl_common import write_AWS, download_embedding_cache, get_arguments
+from etl_chunks_store import (
+    EMBEDDING_COLUMNS,
+    CSVChunksStore,
+    ParquetChunksStore,
+    open_chunks_store,
+)
+from etl_files_tracker import FilesTracker, open_files_tracker
+from etl_embedding_models import EMBEDDING_MODEL, encode
+from etl_cache import EmbeddingCache
 
 from dotenv import load_dotenv, find_dotenv
 
 _ = load_dotenv(find_dotenv())  # read local .env file
 
-
 @task(name="Initialize VectorDatabase", log_prints=True)
 def initialize_vectordb(collection_name: str) -> weaviate.Client:
     """
@@ -92,7 +100,12 @@ def initialize_vectordb(collection_name: str) -> weaviate.Client:
     return client
 
 
-def add_object(collection_name: str, client: weaviate.Client, obj: dict) -> None:
+def add_object(
+    collection_name: str,
+    client: weaviate.Client,
+    obj: dict,
+    vector: Optional[List[float]] = None,
+) -> None:
     """
     Function to add an object to the Vector Database.
     This is a sub-function of the populate_vectordb Task.
@@ -101,6 +114,7 @@ def add_object(collection_name: str, client: weaviate.Client, obj: dict) -> None
     - collection_name (str): The name of the collection in the Vector Database.
     - client (weaviate.Client): The Vector Database client.
     - obj (dict): The object to be added to the Vector Database.
+    - vector (Optional[List[float]]): The embedding of the object (computed by Weaviate if None).
 
     Returns:
     None
@@ -126,7 +140,7 @@ def add_object(collection_name: str, client: weaviate.Client, obj: dict) -> None
             data_object=properties,
             class_name=collection_name,
             # If you Bring Your Own Vectors, add the `vector` parameter here
-            # vector=obj.vector
+            vector=vector,
         )
 
         # Calculate and display progress
@@ -140,9 +154,10 @@ def add_object(collection_name: str, client: weaviate.Client, obj: dict) -> None
 def populate_vectordb(
     collection_name: str,
     client: weaviate.Client,
-    files_tracker: pd.DataFrame,
-    data: pd.DataFrame,
+    files_tracker: FilesTracker,
+    chunks_store: Union[CSVChunksStore, ParquetChunksStore],
     max_doc: int,
+    embedding_cache: Optional[EmbeddingCache] = None,
 ) -> None:
     """
     Task to populate the Vector Database with document information.
@@ -150,9 +165,12 @@ def populate_vectordb(
     Parameters:
     - collection_name (str): The name of the collection in the Vector Database.
     - client (weaviate.Client): The Vector Database client.
-    - files_tracker (pd.DataFrame): DataFrame containing file tracking information.
-    - data (pd.DataFrame): DataFrame containing document information.
+    - files_tracker (FilesTracker): The files tracker.
+    - chunks_store (Union[CSVChunksStore, ParquetChunksStore]): The store of the extracted chunks.
+      Only the chunks of the files to index are loaded.
     - max_doc (int): The maximum number of documents to process.
+    - embedding_cache (Optional[EmbeddingCache]): The cache of the embeddings. If given, the vectors
+      are computed locally (reusing the cached ones) instead of by the Weaviate vectorizer.
 
     Returns:
     None
@@ -162,6 +180,11 @@ def populate_vectordb(
     counter = i = 0
     num_files = len(files_tracker)
 
+    # Count the chunks of each file, reading their hashes only
+    num_chunks = chunks_store.load(columns=["file_hash"])["file_hash"].value_counts()
+
+    # Select the files to index: the files whose chunks aren't in the VectorDB, or differ from them
+    files_to_index = []
     for j, file in enumerate(files_tracker.itertuples()):
 
         if max_doc is not None and i >= max_doc and file.file_name[-3:].lower() == "pdf" :
@@ -169,8 +192,6 @@ def populate_vectordb(
 
         print(f"{j}/{num_files} | Dealing with {file.file_name}")
 
-        doc_chunks = data[data["file_hash"] == file.file_hash]
-
         where = {
             "path": ["file_hash"],
             "operator": "Equal",
@@ -195,7 +216,7 @@ def populate_vectordb(
         print(f"There are {num_chunks_db} entries from {file.file_name}")
 
         # Delete the previous entries
-        if len(doc_chunks) != num_chunks_db and num_chunks_db > 0:
+        if num_chunks.get(str(file.file_hash), 0) != num_chunks_db and num_chunks_db > 0:
             print(f"Deleting {num_chunks_db} entries")
 
             del_result = client.batch.delete_objects(
@@ -203,12 +224,8 @@ def populate_vectordb(
             )
             num_chunks_db = 0
 
-        # Push the new entries
         if num_chunks_db == 0:
-            print(f"Adding the {len(doc_chunks)} entries")
-            for index, row in doc_chunks.iterrows():
-                add_object(collection_name, client, row)
-
+            files_to_index.append(file)
         else:
             print(
                 f"The last version of {file.file_name} has already been embedded and indexed"
@@ -217,6 +234,28 @@ def populate_vectordb(
         if file.file_name[-3:].lower() == "pdf":
             i += 1
 
+    # Load the extracted chunks of the files to index only (without the blocs)
+    data = chunks_store.load(
+        columns=EMBEDDING_COLUMNS, file_hashes=[file.file_hash for file in files_to_index]
+    )
+    data = data.replace(np.nan, None)
+
+    # Push the new entries
+    for file in files_to_index:
+        doc_chunks = data[data["file_hash"] == str(file.file_hash)]
+        print(f"Adding the {len(doc_chunks)} entries of {file.file_name}")
+
+        vectors = [None] * len(doc_chunks)
+        if embedding_cache is not None and len(doc_chunks) > 0:
+            vectors = encode(
+                doc_chunks["chunk"].tolist(),
+                embedding_cache.model_name,
+                cache=embedding_cache,
+            )
+
+        for (index, row), vector in zip(doc_chunks.iterrows(), vectors):
+            add_object(collection_name, client, row, vector)
+
     # Check VectorDB content
     classes = [d["class"] for d in client.schema.get()["classes"]]
 
@@ -255,12 +294,23 @@ def query_test(client: weaviate.Client, collection_name: str) -> None:
 
 
 @flow(log_prints=True)
-def omdena_ungdc_etl_embedding_parent(max_doc: int = None) -> None:
+def omdena_ungdc_etl_embedding_parent(
+    max_doc: int = None,
+    tracker_backend: str = "csv",
+    chunks_backend: str = "csv",
+    local_vectors: bool = False,
+    embed_model: str = EMBEDDING_MODEL,
+) -> None:
     """
     Prefect flow for orchestrating document Embedding and Indexing.
 
     Parameters:
     - max_doc (int): The maximum number of documents to process.
+    - tracker_backend (str): The files tracker backend, "csv" or "sqlite".
+    - chunks_backend (str): The chunks store backend, "csv" or "parquet".
+    - local_vectors (bool): Whether to compute the vectors locally, with the embedding cache shared with
+      the ChromaDB flow, instead of with the Weaviate vectorizer.
+    - embed_model (str): The name of the SentenceTransformer model (must match the Weaviate vectorizer).
 
     Returns:
     None
@@ -275,27 +325,38 @@ def omdena_ungdc_etl_embedding_parent(max_doc: int = None) -> None:
     if not os.path.exists(local_dir):
         raise Exception("The source folder doesn't exist")
 
-    files_tracker_path = Path(local_dir, "files_tracker.csv")
-    if not os.path.exists(files_tracker_path):
-        read_AWS(files_tracker_path, files_tracker_path, bucket_block)
-    files_tracker = pd.read_csv(files_tracker_path)
+    files_tracker = open_files_tracker(local_dir, bucket_block, tracker_backend)
 
-    # Load the extracted chunks
-    pd_chunk_path = Path(local_dir, "extracted_chunks.csv")
-    if not os.path.exists(pd_chunk_path):
-        read_AWS(pd_chunk_path, pd_chunk_path, bucket_block)
-    data = pd.read_csv(pd_chunk_path)
-    data = data.replace(np.nan, None)
+    # Open the extracted chunks (loaded for the files to index only)
+    chunks_store = open_chunks_store(local_dir, bucket_block, chunks_backend)
 
     collection_name = "OmdenaUngdcDocs"
     client = initialize_vectordb(collection_name)
-    populate_vectordb(collection_name, client, files_tracker, data, max_doc)
+    # Define the cache of the embeddings (shared with the ChromaDB flow)
+    embedding_cache = None
+    if local_vectors:
+        embedding_cache = EmbeddingCache(Path(local_dir, "cache", "embeddings"), embed_model)
+
+        # Get the embeddings computed by the previous runs
+        remote_entries = download_embedding_cache(embedding_cache, bucket_block)
+
+    populate_vectordb(
+        collection_name,
+        client,
+        files_tracker,
+        quote(chunks_store),
+        max_doc,
+        quote(embedding_cache),
+    )
 
-    files_tracker.to_csv(files_tracker_path, index=False)
-    write_AWS(files_tracker_path, files_tracker_path, bucket_block)
+    files_tracker.save()
+    write_AWS(files_tracker.path, files_tracker.path, bucket_block)
 
     weaviate_db_path = Path(local_dir, "weaviate_data")
     write_AWS(weaviate_db_path, weaviate_db_path, bucket_block)
+    # Upload the cache only if it holds entries missing from AWS-S3
+    if embedding_cache is not None and len(embedding_cache) > remote_entries:
+        write_AWS(embedding_cache.path, embedding_cache.path, bucket_block)
 
     # Query
     query_test(client, collection_name)
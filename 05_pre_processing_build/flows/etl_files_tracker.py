@@ -0,0 +1,621 @@
+"""
+Files Tracker
+
+This module defines the files tracker shared by the ETL flows.
+The tracker lists the collected files (PDF submissions and PowerBI records) along with
+their processing status (parsed, embedded, indexed).
+
+Classes:
+- FilesTracker: In-memory files tracker indexed by file hash, loaded from and saved to a CSV file.
+- SQLiteFilesTracker: Files tracker stored in an embedded SQLite database, updated row by row.
+
+Functions:
+- open_files_tracker: Downloads (if needed) and opens the files tracker of the selected backend.
+
+Note: The rows of the CSV tracker are kept as plain dictionaries and are only turned into a DataFrame
+when the tracker is saved, so lookups by hash and appends don't scan or copy the whole table.
+The SQLite tracker commits each update immediately, so a crash doesn't lose the progress already made.
+"""
+import os
+import sqlite3
+from collections import namedtuple
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+from prefect_aws import S3Bucket
+
+from etl_common import download_AWS_object
+
+
+FILES_TRACKER_COLUMNS = [
+    "file_hash",
+    "file_name",
+    "file_creation_time",
+    "present_in_last_update",
+    "parsed",
+    "embedded",
+    "indexed",
+]
+
+FILES_TRACKER_STATUS_COLUMNS = [
+    "present_in_last_update",
+    "parsed",
+    "embedded",
+    "indexed",
+]
+
+FILES_TRACKER_BACKENDS = {
+    "csv": "files_tracker.csv",
+    "sqlite": "files_tracker.db",
+}
+
+class FilesTracker:
+    """
+    Files tracker indexed by file hash.
+
+    Rows are addressed by their position (the `Index` field returned by `itertuples`),
+    which stays stable for the lifetime of the tracker.
+    """
+
+    def __init__(
+        self,
+        rows: Optional[Iterable[Dict[str, Any]]] = None,
+        columns: Optional[List[str]] = None,
+        path: Optional[Path] = None,
+    ) -> None:
+        """
+        Parameters:
+        - rows (Optional[Iterable[Dict[str, Any]]]): The initial rows of the tracker.
+        - columns (Optional[List[str]]): The columns of the tracker (defaults to FILES_TRACKER_COLUMNS).
+        - path (Optional[Path]): The CSV file the tracker is saved to.
+        """
+
+        self.path = path
+        self.columns = list(columns or FILES_TRACKER_COLUMNS)
+        self._rows: List[Dict[str, Any]] = []
+        self._hashes: Dict[str, int] = {}
+        self._names: Dict[str, int] = {}
+
+        self.extend(rows or [])
+
+    @classmethod
+    def from_csv(cls, path: Path) -> "FilesTracker":
+        """
+        Loads the tracker from a CSV file, or creates an empty one if the file doesn't exist.
+
+        Parameters:
+        - path (Path): The path to the CSV file.
+
+        Returns:
+        FilesTracker: The loaded tracker.
+        """
+
+        if not os.path.exists(path):
+            return cls(path=path)
+
+        data = pd.read_csv(path)
+        return cls(data.to_dict("records"), list(data.columns), path)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Materializes the tracker as a DataFrame.
+
+        Returns:
+        pd.DataFrame: The tracker rows, in insertion order.
+        """
+
+        return pd.DataFrame(self._rows, columns=self.columns)
+
+    def to_csv(self, path: Path) -> None:
+        """
+        Saves the tracker to a CSV file.
+
+        Parameters:
+        - path (Path): The path to the CSV file.
+
+        Returns:
+        None
+        """
+
+        self.to_frame().to_csv(path, index=False)
+
+    def save(self) -> None:
+        """
+        Saves the tracker to the CSV file it was loaded from.
+        """
+
+        self.to_csv(self.path)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, file_hash: Any) -> bool:
+        return str(file_hash) in self._hashes
+
+    def index_of(self, file_hash: Any) -> Optional[int]:
+        """
+        Returns the position of the first row with the given file hash, or None.
+        """
+
+        return self._hashes.get(str(file_hash))
+
+    def index_of_file_name(self, file_name: str) -> Optional[int]:
+        """
+        Returns the position of the last row with the given file name, or None.
+        """
+
+        return self._names.get(file_name)
+
+    def get(self, index: int) -> Dict[str, Any]:
+        """
+        Returns a copy of the row at the given position.
+        """
+
+        return dict(self._rows[index])
+
+    def set(self, index: int, column: str, value: Any) -> None:
+        """
+        Sets the value of a column for the row at the given position.
+
+        Parameters:
+        - index (int): The position of the row.
+        - column (str): The column to update.
+        - value (Any): The new value.
+
+        Returns:
+        None
+        """
+
+        self.add_columns([column])
+        self._rows[index][column] = value
+
+    def set_all(self, column: str, value: Any) -> None:
+        """
+        Sets the value of a column for all the rows.
+        """
+
+        self.add_columns([column])
+        for row in self._rows:
+            row[column] = value
+
+    def set_many(self, indexes: Iterable[int], column: str, value: Any) -> None:
+        """
+        Sets the value of a column for the rows at the given positions.
+        """
+
+        self.add_columns([column])
+        for index in indexes:
+            self._rows[index][column] = value
+
+    def add_columns(self, columns: Iterable[str]) -> None:
+        """
+        Adds the given columns to the tracker if they don't exist yet.
+        """
+
+        for column in columns:
+            if column not in self.columns:
+                self.columns.append(column)
+
+    def append(self, row: Dict[str, Any]) -> int:
+        """
+        Appends a row to the tracker.
+
+        Parameters:
+        - row (Dict[str, Any]): The new row.
+
+        Returns:
+        int: The position of the new row.
+        """
+
+        self.add_columns(row.keys())
+
+        index = len(self._rows)
+        self._rows.append(dict(row))
+        self._hashes.setdefault(str(row.get("file_hash")), index)
+        self._names[row.get("file_name")] = index
+
+        return index
+
+    def extend(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """
+        Appends several rows to the tracker.
+        """
+
+        for row in rows:
+            self.append(row)
+
+    def drop_duplicates(self, columns: List[str]) -> int:
+        """
+        Removes the rows duplicating an earlier row on the given columns.
+        The positions of the remaining rows change, so it must not be called while iterating.
+
+        Parameters:
+        - columns (List[str]): The columns identifying a row (e.g. ["file_hash", "file_name"]).
+
+        Returns:
+        int: The number of rows removed.
+        """
+
+        seen = set()
+        rows = []
+        for row in self._rows:
+            key = tuple(str(row.get(c)) for c in columns)
+            if key not in seen:
+                seen.add(key)
+                rows.append(row)
+
+        num_removed = len(self._rows) - len(rows)
+        if num_removed > 0:
+            self._rows, self._hashes, self._names = [], {}, {}
+            self.extend(rows)
+
+        return num_removed
+
+    def itertuples(self, **conditions: Any) -> Iterator[Tuple]:
+        """
+        Iterates over the rows as namedtuples, like `pd.DataFrame.itertuples`.
+
+        Parameters:
+        - conditions (Any): Optional `column=value` filters (e.g. parsed=False).
+
+        Returns:
+        Iterator[Tuple]: The rows, with their position as `Index`.
+        """
+
+        TrackedFile = namedtuple("TrackedFile", ["Index"] + self.columns, rename=True)
+
+        for index, row in enumerate(self._rows):
+            if all(row.get(c) == v for c, v in conditions.items()):
+                yield TrackedFile(index, *[row.get(c) for c in self.columns])
+
+
+class SQLiteFilesTracker:
+    """
+    Files tracker stored in an embedded SQLite database.
+
+    It exposes the same interface as FilesTracker, but every update is a single indexed
+    row update committed immediately. Rows are addressed by their SQLite row id
+    (the `Index` field returned by `itertuples`).
+    """
+
+    table = "files_tracker"
+
+    def __init__(self, path: Path) -> None:
+        """
+        Parameters:
+        - path (Path): The SQLite database file (created if it doesn't exist).
+        """
+
+        self.path = path
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+
+        columns = ", ".join(
+            f'"{c}" BOOLEAN' if c in FILES_TRACKER_STATUS_COLUMNS else f'"{c}"'
+            for c in FILES_TRACKER_COLUMNS
+            if c != "file_hash"
+        )
+        with self.connection:
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                f'(id INTEGER PRIMARY KEY, "file_hash" TEXT, {columns})'
+            )
+            self.connection.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_file_hash ON {self.table} (file_hash)"
+            )
+            self.connection.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_file_name ON {self.table} (file_name)"
+            )
+            self.connection.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_status ON {self.table} "
+                "(present_in_last_update, parsed, embedded, indexed)"
+            )
+
+        self.columns = [
+            c[1]
+            for c in self.connection.execute(f"PRAGMA table_info({self.table})")
+            if c[1] != "id"
+        ]
+
+    @classmethod
+    def from_csv(cls, csv_path: Path, path: Path) -> "SQLiteFilesTracker":
+        """
+        Opens the SQLite tracker, importing the rows of the CSV tracker if the database doesn't exist yet.
+
+        Parameters:
+        - csv_path (Path): The path to the CSV tracker to import.
+        - path (Path): The path to the SQLite database.
+
+        Returns:
+        SQLiteFilesTracker: The opened tracker.
+        """
+
+        is_new = not os.path.exists(path)
+        files_tracker = cls(path)
+
+        if is_new and os.path.exists(csv_path):
+            print(f"Import {csv_path} into {path}")
+            csv_tracker = FilesTracker.from_csv(csv_path)
+            files_tracker.extend(csv_tracker.get(i) for i in range(len(csv_tracker)))
+
+        return files_tracker
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Materializes the tracker as a DataFrame.
+
+        Returns:
+        pd.DataFrame: The tracker rows, in insertion order.
+        """
+
+        cursor = self.connection.execute(f"SELECT * FROM {self.table} ORDER BY id")
+        names = [d[0] for d in cursor.description]
+        data = pd.DataFrame.from_records(
+            [_from_sql_row(names, row) for row in cursor.fetchall()], columns=names
+        )
+        return data.drop(columns=["id"])
+
+    def to_csv(self, path: Path) -> None:
+        """
+        Exports the tracker to a CSV file.
+
+        Parameters:
+        - path (Path): The path to the CSV file.
+
+        Returns:
+        None
+        """
+
+        self.to_frame().to_csv(path, index=False)
+
+    def save(self) -> None:
+        """
+        Commits the pending changes (updates are already committed one by one).
+        """
+
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        return self.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def __contains__(self, file_hash: Any) -> bool:
+        return self.index_of(file_hash) is not None
+
+    def _fetch_id(self, query: str, value: Any) -> Optional[int]:
+        row = self.connection.execute(query, (value,)).fetchone()
+        return row[0] if row is not None else None
+
+    def index_of(self, file_hash: Any) -> Optional[int]:
+        """
+        Returns the id of the first row with the given file hash, or None.
+        """
+
+        return self._fetch_id(
+            f"SELECT id FROM {self.table} WHERE file_hash = ? ORDER BY id LIMIT 1",
+            str(file_hash),
+        )
+
+    def index_of_file_name(self, file_name: str) -> Optional[int]:
+        """
+        Returns the id of the last row with the given file name, or None.
+        """
+
+        return self._fetch_id(
+            f"SELECT id FROM {self.table} WHERE file_name = ? ORDER BY id DESC LIMIT 1",
+            file_name,
+        )
+
+    def get(self, index: int) -> Dict[str, Any]:
+        """
+        Returns the row with the given id.
+        """
+
+        cursor = self.connection.execute(
+            f"SELECT * FROM {self.table} WHERE id = ?", (index,)
+        )
+        names = [d[0] for d in cursor.description]
+        row = dict(zip(names, _from_sql_row(names, cursor.fetchone())))
+        row.pop("id")
+
+        return row
+
+    def set(self, index: int, column: str, value: Any) -> None:
+        """
+        Sets the value of a column for the row with the given id, and commits it.
+
+        Parameters:
+        - index (int): The id of the row.
+        - column (str): The column to update.
+        - value (Any): The new value.
+
+        Returns:
+        None
+        """
+
+        self.add_columns([column])
+        with self.connection:
+            self.connection.execute(
+                f'UPDATE {self.table} SET "{column}" = ? WHERE id = ?',
+                (_to_sql_value(value), index),
+            )
+
+    def set_all(self, column: str, value: Any) -> None:
+        """
+        Sets the value of a column for all the rows, and commits it.
+        """
+
+        self.add_columns([column])
+        with self.connection:
+            self.connection.execute(
+                f'UPDATE {self.table} SET "{column}" = ?', (_to_sql_value(value),)
+            )
+
+    def set_many(self, indexes: Iterable[int], column: str, value: Any) -> None:
+        """
+        Sets the value of a column for the rows with the given ids, and commits them in a single transaction.
+        """
+
+        self.add_columns([column])
+        with self.connection:
+            self.connection.executemany(
+                f'UPDATE {self.table} SET "{column}" = ? WHERE id = ?',
+                [(_to_sql_value(value), index) for index in indexes],
+            )
+
+    def add_columns(self, columns: Iterable[str]) -> None:
+        """
+        Adds the given columns to the tracker if they don't exist yet.
+        """
+
+        new_columns = [c for c in dict.fromkeys(columns) if c not in self.columns]
+        if len(new_columns) == 0:
+            return
+
+        with self.connection:
+            for column in new_columns:
+                self.connection.execute(
+                    f'ALTER TABLE {self.table} ADD COLUMN "{column}"'
+                )
+        self.columns.extend(new_columns)
+
+    def append(self, row: Dict[str, Any]) -> int:
+        """
+        Appends a row to the tracker, and commits it.
+
+        Parameters:
+        - row (Dict[str, Any]): The new row.
+
+        Returns:
+        int: The id of the new row.
+        """
+
+        self.add_columns(row.keys())
+        with self.connection:
+            return self._insert(row)
+
+    def extend(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """
+        Appends several rows to the tracker in a single transaction.
+        """
+
+        rows = list(rows)
+
+        # The columns are added before the transaction, so the rows are committed together
+        self.add_columns(c for row in rows for c in row.keys())
+        with self.connection:
+            for row in rows:
+                self._insert(row)
+
+    def _insert(self, row: Dict[str, Any]) -> int:
+        values = {c: _to_sql_value(v) for c, v in row.items()}
+        values["file_hash"] = str(row.get("file_hash"))
+        names = ", ".join(f'"{c}"' for c in values)
+        placeholders = ", ".join("?" for _ in values)
+
+        cursor = self.connection.execute(
+            f"INSERT INTO {self.table} ({names}) VALUES ({placeholders})",
+            list(values.values()),
+        )
+        return cursor.lastrowid
+
+    def drop_duplicates(self, columns: List[str]) -> int:
+        """
+        Removes the rows duplicating an earlier row on the given columns, and commits it.
+
+        Parameters:
+        - columns (List[str]): The columns identifying a row (e.g. ["file_hash", "file_name"]).
+
+        Returns:
+        int: The number of rows removed.
+        """
+
+        names = ", ".join(f'"{c}"' for c in columns)
+        with self.connection:
+            cursor = self.connection.execute(
+                f"DELETE FROM {self.table} WHERE id NOT IN "
+                f"(SELECT MIN(id) FROM {self.table} GROUP BY {names})"
+            )
+
+        return cursor.rowcount
+
+    def itertuples(self, **conditions: Any) -> Iterator[Tuple]:
+        """
+        Iterates over the rows as namedtuples, like `pd.DataFrame.itertuples`.
+
+        Parameters:
+        - conditions (Any): Optional `column=value` filters (e.g. parsed=False), resolved by SQLite.
+
+        Returns:
+        Iterator[Tuple]: The rows, with their id as `Index`.
+        """
+
+        TrackedFile = namedtuple("TrackedFile", ["Index"] + self.columns, rename=True)
+
+        columns = ["id"] + self.columns
+        names = ", ".join(f'"{c}"' for c in columns)
+        where = " AND ".join(f'"{c}" = ?' for c in conditions) or "1"
+        cursor = self.connection.execute(
+            f"SELECT {names} FROM {self.table} WHERE {where} ORDER BY id",
+            [_to_sql_value(v) for v in conditions.values()],
+        )
+
+        # Fetch everything first, so the rows can be updated while iterating
+        for row in cursor.fetchall():
+            yield TrackedFile(*_from_sql_row(columns, row))
+
+
+def _from_sql_row(names: List[str], row: Tuple) -> Tuple:
+    """
+    Converts back to booleans the status columns of a row read from SQLite (stored as integers).
+    """
+
+    return tuple(
+        bool(value) if name in FILES_TRACKER_STATUS_COLUMNS and value is not None else value
+        for name, value in zip(names, row)
+    )
+
+
+def _to_sql_value(value: Any) -> Any:
+    """
+    Converts numpy / pandas scalars (and NaN) into values supported by SQLite.
+    """
+
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        value = None
+
+    return value
+
+
+def open_files_tracker(
+    local_dir: Union[str, Path], bucket_block: S3Bucket, backend: str = "csv"
+) -> Union[FilesTracker, SQLiteFilesTracker]:
+    """
+    Downloads the files tracker from AWS-S3 if it isn't available locally, and opens it.
+
+    Parameters:
+    - local_dir (Union[str, Path]): The local directory of the tracker.
+    - bucket_block (S3Bucket): The Prefect S3Bucket object representing the AWS-S3 bucket.
+    - backend (str): The tracker backend, "csv" or "sqlite".
+      The SQLite tracker is initialized from the CSV tracker the first time it is used.
+
+    Returns:
+    Union[FilesTracker, SQLiteFilesTracker]: The opened tracker (its `path` is the file to upload).
+    """
+
+    if backend not in FILES_TRACKER_BACKENDS:
+        raise Exception(f"Unknown files tracker backend: {backend}")
+
+    csv_path = Path(local_dir, FILES_TRACKER_BACKENDS["csv"])
+    path = Path(local_dir, FILES_TRACKER_BACKENDS[backend])
+
+    if not os.path.exists(path):
+        download_AWS_object(path, path, bucket_block)
+
+    if backend == "sqlite":
+        if not os.path.exists(path) and not os.path.exists(csv_path):
+            download_AWS_object(csv_path, csv_path, bucket_block)
+        return SQLiteFilesTracker.from_csv(csv_path, path)
+
+    return FilesTracker.from_csv(path)
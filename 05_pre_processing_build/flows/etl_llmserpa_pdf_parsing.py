@@ -7,110 +7,317 @@ This script defines a Prefect flow for parsing PDF documents using llmsherpa.
 The flow includes a task for parsing PDF and saving the extracted information to a CSV file.
 
 Tasks:
-- Parse PDF: Utilizes llmsherpa API to parse PDF documents and extracts chunks and sections.
-  The extracted information is saved to a CSV file.
+- Parse PDF Concurrent: Sends several PDF documents in parallel to the llmsherpa API
+  (bounded pool, with a timeout and retries on each request). The layouts are cached by file hash.
+- Rebuild Chunks: Rebuilds the chunks of already parsed documents from their cached layout.
+
+Functions:
+- document_chunks: Extracts the chunks and blocs of a parsed document into a single dataframe.
+- get_api_urls: Returns the parsing endpoints (flow parameter, LLMSHERPA_API_URL environment variable,
+  or public llmsherpa API).
+- request_layout: Sends a PDF file to the llmsherpa API and returns the layout blocks of the document.
 
 Prefect Flow:
 - omdena_ungdc_etl_pdf_parsing_parent: Orchestrates the PDF parsing process for multiple files.
   - Reads file information from an AWS S3 bucket.
-  - Parses each PDF using llmsherpa and extracts chunks and sections.
+  - Parses the PDF files concurrently using llmsherpa and extracts chunks and sections.
   - Saves the extracted information to a CSV file.
 
 Note: Ensure that the 'llmsherpa', 'prefect', and 'prefect_aws' packages are installed for proper execution.
 """
 
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
-from llmsherpa.readers import LayoutPDFReader
+import requests
+from llmsherpa.readers.layout_reader import Document
 
 from prefect import flow, task
+from prefect.utilities.annotations import quote
 from prefect_aws import S3Bucket
 
-from etl_common import read_AWS, write_AWS, get_arguments
+from etl_common import read_AWS, write_AWS, create_session, get_arguments
+from etl_cache import ParseCache, canonical_hash
+from etl_chunks_store import CHUNKS_COLUMNS, open_chunks_store
+from etl_files_tracker import open_files_tracker
 
 # from llama_index import VectorStoreIndex
 
+LLMSHERPA_API_URL = "https://readers.llmsherpa.com/api/document/developer/parseDocument?renderFormat=all"
+
+# Environment variable listing the parsing endpoints (comma-separated), e.g. self-hosted nlm-ingestor servers:
+# LLMSHERPA_API_URL=http://localhost:5010/api/parseDocument?renderFormat=all
+LLMSHERPA_API_URL_ENV = "LLMSHERPA_API_URL"
+
+# Parsing requests: timeout (in seconds), number of retries and initial backoff (in seconds, doubled on each retry)
+PARSE_TIMEOUT = 300
+PARSE_RETRIES = 3
+PARSE_BACKOFF = 2.0
+
+
+def document_chunks(doc: Document, file_name: str, file_hash: str) -> pd.DataFrame:
+    """
+    Extracts the chunks of a document parsed by llmsherpa.
+
+    The consecutive chunks sharing the same header form a bloc, whose text is stored with each of them.
+
+    Parameters:
+    - doc (Document): The llmsherpa document.
+    - file_name (str): The name of the parsed file.
+    - file_hash (str): The hash of the parsed file.
+
+    Returns:
+    pd.DataFrame: The chunks of the document.
+    """
+
+    pages, levels, headers, texts, bloc_texts = [], [], [], [], []
+
+    for chunk in doc.chunks():
+        text_w_context = chunk.to_context_text()
+        # header = chunk.parent.to_text()
+        header = text_w_context.split("\n")[0]
+
+        pages.append(chunk.page_idx)
+        levels.append(chunk.level)
+        headers.append(header)
+        texts.append(chunk.to_text())
+        bloc_texts.append(text_w_context.replace(header or "", ""))
+
+    # The bloc of a chunk is the text of all the consecutive chunks with the same header
+    blocs = []
+    start = 0
+    for end in range(1, len(headers) + 1):
+        if end == len(headers) or headers[end] != headers[start]:
+            blocs.extend(["".join(bloc_texts[start:end])] * (end - start))
+            start = end
+
+    return pd.DataFrame(
+        {
+            "file_hash": file_hash,
+            "file_name": file_name,
+            "page": pages,
+            "level": levels,
+            "type": None,
+            "header": headers,
+            "chunk": texts,
+            "bloc": blocs,
+            # "header_chunk": chunk.to_context_text(),
+        },
+        columns=CHUNKS_COLUMNS,
+    )
+
 
-@task(name="LLMsherpa Parse PDF", log_prints=True)
-def parse_PDF(
-    pdf_reader: LayoutPDFReader,
+def get_api_urls(api_urls: Optional[str] = None) -> List[str]:
+    """
+    Returns the parsing endpoints: the given ones, or those of the LLMSHERPA_API_URL environment variable,
+    or the public llmsherpa API.
+
+    Parameters:
+    - api_urls (Optional[str]): Comma-separated URLs of the parsing API.
+
+    Returns:
+    List[str]: The URLs of the parsing API.
+    """
+
+    api_urls = api_urls or os.environ.get(LLMSHERPA_API_URL_ENV) or LLMSHERPA_API_URL
+    urls = [url.strip() for url in api_urls.split(",") if url.strip()]
+
+    if len(urls) == 0:
+        raise Exception("No parsing endpoint was provided")
+
+    return urls
+
+
+def request_layout(
+    session: requests.Session,
+    api_urls: List[str],
     file_path: Path,
-    pd_chunks: pd.DataFrame,
-    file_infos: pd.DataFrame,
-):
+    timeout: float = PARSE_TIMEOUT,
+    retries: int = PARSE_RETRIES,
+    backoff: float = PARSE_BACKOFF,
+) -> List[Dict[str, Any]]:
     """
-    Task to parse PDF documents using llmsherpa API.
+    Sends a PDF file to the llmsherpa (or nlm-ingestor) API and returns the layout blocks of the document.
+
+    Connection errors, timeouts, rate limits (429) and server errors (5xx) are retried
+    with an exponential backoff, each retry on the next endpoint. Other errors are raised immediately.
 
     Parameters:
-    - pdf_reader (LayoutPDFReader): The LLMsherpa reader instance
-    - file_path (str): Path to the PDF file to be parsed.
-    - pd_chunks (pd.DataFrame): The pandas dataframe to store the extracted infos.
-    - file_infos (pd.DataFrame): Information about the file being processed.
+    - session (requests.Session): The HTTP session.
+    - api_urls (List[str]): The URLs of the parsing API, the first one is tried first.
+    - file_path (Path): Path to the PDF file to be parsed.
+    - timeout (float): The timeout of each request, in seconds.
+    - retries (int): The maximum number of retries.
+    - backoff (float): The delay before the first retry, in seconds (doubled on each retry).
 
     Returns:
-    pd.DataFrame: The modified pandas dataframe.
+    List[Dict[str, Any]]: The layout blocks (to build an llmsherpa Document).
     """
 
-    doc = pdf_reader.read_pdf(str(file_path))
+    with open(file_path, "rb") as f:
+        file_data = f.read()
 
-    old_header = None
-    bloc_text = ""
-    bloc_indexes = []
-    index = pd_chunks.shape[0]
+    for attempt in range(retries + 1):
+        try:
+            r = session.post(
+                api_urls[attempt % len(api_urls)],
+                files={"file": (os.path.split(file_path)[-1], file_data, "application/pdf")},
+                timeout=timeout,
+            )
+            if r.status_code != 429 and r.status_code < 500:
+                r.raise_for_status()
+                return r.json()["return_dict"]["result"]["blocks"]
 
-    for j, chunk in enumerate(doc.chunks()):
-        # header = chunk.parent.to_text()
-        header = chunk.to_context_text().split("\n")[0]
-        page = chunk.page_idx
-        level = chunk.level
-        text = chunk.to_text()
-        text_w_context = chunk.to_context_text()
-        text_w_context_clean = text_w_context.replace(header or "", "")
+            error = Exception(f"The parsing API returned {r.status_code}: {r.text[:200]}")
 
-        if header is None:
-            text = text_w_context_clean
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
 
-        new_line = {
-            "file_hash": file_infos.file_hash,
-            "file_name": os.path.split(file_path)[-1],
-            "page": page,
-            "level": level,
-            "type": None,
-            "header": header,
-            "chunk": chunk.to_text(),
-            "bloc": None
-            # "header_chunk": chunk.to_context_text(),
-        }
-        pd_chunks = pd.concat(
-            [pd_chunks, pd.DataFrame([new_line])], axis="index", ignore_index=True
-        )
+        if attempt < retries:
+            delay = backoff * 2**attempt
+            print(f"Parsing {file_path} failed ({error}), retry in {delay}s")
+            time.sleep(delay)
 
-        if old_header != header:
-            pd_chunks.loc[bloc_indexes, "bloc"] = bloc_text
-            old_header = header
-            bloc_text = text_w_context_clean
-            bloc_indexes = []
-        else:
-            bloc_text += text_w_context_clean
+    raise error
 
-        bloc_indexes.append(index)
-        index += 1
 
-        if j == len(doc.chunks()) - 1:
-            pd_chunks.loc[bloc_indexes, "bloc"] = bloc_text
+def parse_file(
+    session: requests.Session,
+    api_urls: List[str],
+    file_path: Path,
+    file_hash: str,
+    timeout: float = PARSE_TIMEOUT,
+    retries: int = PARSE_RETRIES,
+    cache: Optional[ParseCache] = None,
+) -> pd.DataFrame:
+    """
+    Parses a PDF file with the llmsherpa API (or takes its layout from the cache) and extracts its chunks.
+
+    Parameters:
+    - session (requests.Session): The HTTP session.
+    - api_urls (List[str]): The URLs of the parsing API, the first one is tried first.
+    - file_path (Path): Path to the PDF file to be parsed.
+    - file_hash (str): The hash of the file.
+    - timeout (float): The timeout of each request, in seconds.
+    - retries (int): The maximum number of retries.
+    - cache (Optional[ParseCache]): The cache of the layout blocks.
+
+    Returns:
+    pd.DataFrame: The chunks extracted from the document.
+    """
+
+    blocks = cache.get(file_hash) if cache is not None else None
 
-    return pd_chunks
+    if blocks is None:
+        blocks = request_layout(session, api_urls, file_path, timeout, retries)
+        if cache is not None:
+            cache.put(file_hash, blocks)
+
+    return document_chunks(Document(blocks), os.path.split(file_path)[-1], file_hash)
+
+
+@task(name="LLMsherpa Parse PDF Concurrent", log_prints=True)
+def parse_PDF_concurrent(
+    api_urls: List[str],
+    files: List[Tuple[int, Path, str]],
+    max_workers: int = 4,
+    timeout: float = PARSE_TIMEOUT,
+    retries: int = PARSE_RETRIES,
+    cache: Optional[ParseCache] = None,
+) -> Dict[int, pd.DataFrame]:
+    """
+    Task to parse several PDF documents concurrently using llmsherpa API.
+    The documents are dispatched round-robin over the parsing endpoints.
+
+    Parameters:
+    - api_urls (List[str]): The URLs of the parsing API.
+    - files (List[Tuple[int, Path, str]]): The tracker index, path and hash of the files to parse.
+    - max_workers (int): The maximum number of documents parsed concurrently.
+    - timeout (float): The timeout of each request, in seconds.
+    - retries (int): The maximum number of retries of each request.
+    - cache (Optional[ParseCache]): The cache of the layout blocks (the cached documents aren't sent again).
+
+    Returns:
+    Dict[int, pd.DataFrame]: The chunks of the documents successfully parsed, by tracker index.
+    """
+
+    def parse(i: int, file: Tuple[int, Path, str]) -> Tuple[int, Optional[pd.DataFrame]]:
+        index, file_path, file_hash = file
+        # Start from the i-th endpoint, so consecutive documents go to different endpoints
+        urls = api_urls[i % len(api_urls):] + api_urls[: i % len(api_urls)]
+        try:
+            return index, parse_file(
+                session, urls, file_path, file_hash, timeout, retries, cache
+            )
+        except Exception as e:
+            print(f"A problem occured with PDF parsing on document {file_path}: \n{e}")
+            return index, None
+
+    with create_session(max_workers) as session:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            results = list(executor.map(parse, range(len(files)), files))
+
+    return {index: doc_chunks for index, doc_chunks in results if doc_chunks is not None}
+
+
+@task(name="LLMsherpa Rebuild Chunks", log_prints=True)
+def rebuild_chunks(
+    files: List[Tuple[int, Path, str]], cache: ParseCache
+) -> Dict[int, pd.DataFrame]:
+    """
+    Task to rebuild the chunks of already parsed documents from their cached layout, without calling the API.
+
+    Parameters:
+    - files (List[Tuple[int, Path, str]]): The tracker index, path and hash of the files to rebuild.
+    - cache (ParseCache): The cache of the layout blocks.
+
+    Returns:
+    Dict[int, pd.DataFrame]: The chunks of the documents found in the cache, by tracker index.
+    """
+
+    docs_chunks = {}
+    for index, file_path, file_hash in files:
+        blocks = cache.get(file_hash)
+        if blocks is not None:
+            docs_chunks[index] = document_chunks(
+                Document(blocks), os.path.split(file_path)[-1], file_hash
+            )
+
+    return docs_chunks
 
 
 @flow(log_prints=True)
-def omdena_ungdc_etl_llmsherpa_pdf_parsing_parent(max_doc: int = None) -> None:
+def omdena_ungdc_etl_llmsherpa_pdf_parsing_parent(
+    max_doc: int = None,
+    tracker_backend: str = "csv",
+    chunks_backend: str = "csv",
+    max_workers: int = 4,
+    timeout: float = PARSE_TIMEOUT,
+    retries: int = PARSE_RETRIES,
+    api_urls: Optional[str] = None,
+    rebuild: bool = False,
+    parser_version: Optional[str] = None,
+) -> None:
     """
     Prefect flow for orchestrating PDF parsing using llmsherpa.
 
     Parameters:
     - max_doc (int): The maximum number of documents to process
+    - tracker_backend (str): The files tracker backend, "csv" or "sqlite"
+    - chunks_backend (str): The chunks store backend, "csv" or "parquet"
+    - max_workers (int): The maximum number of documents parsed concurrently
+    - timeout (float): The timeout of each parsing request, in seconds
+    - retries (int): The maximum number of retries of each parsing request
+    - api_urls (Optional[str]): Comma-separated URLs of the parsing API (defaults to the LLMSHERPA_API_URL
+      environment variable, then to the public llmsherpa API)
+    - rebuild (bool): Whether to rebuild the chunks of the already parsed files from the cached layouts
+      (the cache is synced with AWS-S3: the new layouts are uploaded, and downloaded to rebuild)
+    - parser_version (Optional[str]): The identity and version of the parsing server (e.g. "nlm-ingestor-0.1.6"),
+      keying the cached layouts (by default, the parsing endpoints key them)
 
     Returns:
     None
@@ -124,51 +331,41 @@ def omdena_ungdc_etl_llmsherpa_pdf_parsing_parent(max_doc: int = None) -> None:
     if not os.path.exists(local_dir):
         raise Exception("The source folder doesn't exist")
 
-    files_tracker_path = Path(local_dir, "files_tracker.csv")
-    if not os.path.exists(files_tracker_path):
-        read_AWS(files_tracker_path, files_tracker_path, bucket_block)
-    files_tracker = pd.read_csv(files_tracker_path)
+    files_tracker = open_files_tracker(local_dir, bucket_block, tracker_backend)
 
-    # Define the file to save the chunks
-    pd_chunk_path = Path(local_dir, "extracted_chunks.csv")
-    if not os.path.exists(pd_chunk_path):
-        read_AWS(pd_chunk_path, pd_chunk_path, bucket_block)
-
-    if os.path.exists(pd_chunk_path):
-        pd_chunks = pd.read_csv(pd_chunk_path)
-    else:
-        columns = [
-            "file_hash",
-            "file_name",
-            "page",
-            "level",
-            "type",
-            "header",
-            "chunk",
-            "bloc",
-        ]
-        pd_chunks = pd.DataFrame(columns=columns)
+    # Define the store to save the chunks
+    chunks_store = open_chunks_store(local_dir, bucket_block, chunks_backend)
 
     # Define LLMsherpa parser
-    llmsherpa_api = "https://readers.llmsherpa.com/api/document/developer/parseDocument?renderFormat=all"
-    pdf_reader = LayoutPDFReader(llmsherpa_api)
-
-    # Iterate through files and parse PDF
+    llmsherpa_apis = get_api_urls(api_urls)
+    print(f"Parsing endpoints: {llmsherpa_apis}")
+
+    # Define the cache of the parsed layouts
+    # The layouts are produced by the parsing servers, not by the llmsherpa client: they are cached
+    # by server version when it is given, by parsing endpoints otherwise
+    if parser_version is None:
+        parser_version = "endpoints-" + canonical_hash(sorted(llmsherpa_apis))[:16]
+    parse_cache = ParseCache(Path(local_dir, "cache", "parsed"), "llmsherpa", parser_version)
+    if rebuild:
+        read_AWS(parse_cache.path, parse_cache.path, bucket_block)
+
+    # Select the files to parse (or to rebuild)
+    files = []
+    rebuilt_files = []
     i = 0
     for file in files_tracker.itertuples():
         if file.present_in_last_update is True and file.parsed is False:  # ⚠️
-            try:
-                # Parse PDF using LLMsherpa
-                file_path = Path("data", file.file_name)
-                pd_chunks = parse_PDF(pdf_reader, file_path, pd_chunks, file)
-
-                # Update the files_tracker
-                files_tracker.at[file.Index, "parsed"] = True
-            except Exception as e:
-                print(
-                    f"A problem occured with PDF parsing on document {file_path}: \n{e}"
-                )
-
+            files.append((file.Index, Path("data", file.file_name), file.file_hash))
+        elif (
+            rebuild
+            and file.present_in_last_update is True
+            and not str(file.file_name).startswith("PowerBI_")
+        ):
+            # Only the present PDF files can have a layout in the cache
+            if file.file_hash in parse_cache:
+                rebuilt_files.append((file.Index, Path("data", file.file_name), file.file_hash))
+            else:
+                print(f"{file.file_name} can't be rebuilt, its layout isn't in the cache")
         else:
             print(f"The last version of {file.file_name} has already been parsed")
 
@@ -176,11 +373,43 @@ def omdena_ungdc_etl_llmsherpa_pdf_parsing_parent(max_doc: int = None) -> None:
         if max_doc is not None and i >= max_doc:
             break
 
-    pd_chunks.to_csv(pd_chunk_path, index=False)
+    # Parse the PDF files using LLMsherpa
+    docs_chunks = parse_PDF_concurrent(
+        llmsherpa_apis, files, max_workers, timeout, retries, quote(parse_cache)
+    )
+
+    # Rebuild the chunks of the files already parsed
+    if len(rebuilt_files) > 0:
+        rebuilt_chunks = rebuild_chunks(rebuilt_files, quote(parse_cache))
+        print(f"{len(rebuilt_chunks)} documents rebuilt from the cache")
+
+        # The rebuilt chunks must be embedded and indexed again
+        for index in rebuilt_chunks:
+            files_tracker.set(index, "embedded", False)
+            files_tracker.set(index, "indexed", False)
+    else:
+        rebuilt_chunks = {}
+
+    if len(docs_chunks) + len(rebuilt_chunks) > 0:
+        chunks_store.put(
+            pd.concat(
+                [*docs_chunks.values(), *rebuilt_chunks.values()], ignore_index=True
+            )
+        )
+
+    # Update the files_tracker and upload the layouts of the parsed files
+    for index, file_path, file_hash in files:
+        if index in docs_chunks:
+            files_tracker.set(index, "parsed", True)
+            entry_path = parse_cache.entry_path(file_hash)
+            write_AWS(entry_path, entry_path, bucket_block)
+
+    print(f"{len(docs_chunks)} documents parsed, {len(files) - len(docs_chunks)} failed")
 
-    files_tracker.to_csv(files_tracker_path, index=False)
-    write_AWS(files_tracker_path, files_tracker_path, bucket_block)
-    write_AWS(pd_chunk_path, pd_chunk_path, bucket_block)
+    files_tracker.save()
+    write_AWS(files_tracker.path, files_tracker.path, bucket_block)
+    for path in chunks_store.save():
+        write_AWS(path, path, bucket_block)
 
 
 if __name__ == "__main__":
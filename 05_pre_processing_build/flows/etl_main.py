@@ -31,32 +31,44 @@ from etl_embedding_weaviate import omdena_ungdc_etl_embedding_parent
 
 
 @flow(log_prints=True)
-def omdena_ungdc_etl_main_flow(max_doc: int = None) -> None:
+def omdena_ungdc_etl_main_flow(
+    max_doc: int = None, tracker_backend: str = "csv", chunks_backend: str = "csv"
+) -> None:
     """
     The base flow that sequentially calls the other scripts/flows.
 
     Parameters:
     - max_doc (int): The maximum number of documents to process
+    - tracker_backend (str): The files tracker backend shared by the flows, "csv" or "sqlite"
+    - chunks_backend (str): The chunks store backend shared by the flows, "csv" or "parquet"
 
     Returns:
     None
     """
 
     print("Call Web to AWS-S3")
-    omdena_ungdc_etl_web_to_aws_parent(max_doc)
+    omdena_ungdc_etl_web_to_aws_parent(max_doc, tracker_backend=tracker_backend)
 
     print("Call PDF parser")
-    # omdena_ungdc_etl_pdf_parsing_parent(max_doc)
-    omdena_ungdc_etl_llmsherpa_pdf_parsing_parent(max_doc)
+    # omdena_ungdc_etl_pdf_parsing_parent(
+    #     max_doc, tracker_backend=tracker_backend, chunks_backend=chunks_backend
+    # )
+    omdena_ungdc_etl_llmsherpa_pdf_parsing_parent(
+        max_doc, tracker_backend=tracker_backend, chunks_backend=chunks_backend
+    )
 
     print("Call PowerBI scraper")
     omdena_ungdc_etl_scrap_pbi_parent()
 
     print("Call PowerBI parser")
-    omdena_ungdc_etl_powerbi_csv_parsing_parent()
+    omdena_ungdc_etl_powerbi_csv_parsing_parent(
+        tracker_backend=tracker_backend, chunks_backend=chunks_backend
+    )
 
     print("Call Embedding & Indexing")
-    omdena_ungdc_etl_embedding_parent(max_doc)
+    omdena_ungdc_etl_embedding_parent(
+        max_doc, tracker_backend=tracker_backend, chunks_backend=chunks_backend
+    )
 
 
 if __name__ == "__main__":
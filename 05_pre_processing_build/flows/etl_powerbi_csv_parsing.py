@@ -8,6 +8,9 @@ This script defines a Prefect flow for parsing a PowerBI CSV file and updating t
 Tasks:
 - PBI_parse_csv: Parses PowerBI CSV data and updates the chunks dataframe.
 
+Functions:
+- PBI_update_tracker: Upserts the PowerBI records in the files tracker, keyed by Record ID.
+
 Prefect Flow:
 - omdena_ungdc_etl_powerbi_csv_parsing_parent: Orchestrates the process of parsing PowerBI CSV data.
   - Initializes variables for local directory, S3 bucket, and file paths.
@@ -20,7 +23,7 @@ Note: Ensure that the required packages are installed for proper execution.
 
 import os
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Optional, Set, Tuple
 
 import pandas as pd
 from llmsherpa.readers import LayoutPDFReader
@@ -28,114 +31,175 @@ from llmsherpa.readers import LayoutPDFReader
 from prefect import flow, task
 from prefect_aws import S3Bucket
 
-from etl_common import read_AWS, write_AWS, get_arguments
+from etl_common import write_AWS, get_arguments
+from etl_chunks_store import open_chunks_store
+from etl_files_tracker import FilesTracker, open_files_tracker
 
 # from llama_index import VectorStoreIndex
 
+# The chunks of a record are named after its type, location, contact and entity
+# (the separator matches the names of the existing chunks)
+PBI_FILE_NAME_SEPARATOR = "," + " " * 17
 
-@task(name="PowerBI Parse CSV", log_prints=True)
-def PBI_parse_csv( powerbi_data: pd.DataFrame, pd_chunks: pd.DataFrame, files_tracker: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+
+def PBI_update_tracker(
+    files_tracker: FilesTracker, record_ids: pd.Series, changed_ids: Set[str]
+) -> None:
     """
-    Task to parse PowerBI CSV data and update the chunks dataframe.
+    Upserts the PowerBI records in the files tracker, keyed by Record ID.
+
+    Only the unseen records are added, the records missing from the PowerBI data are flagged
+    as not present in the last update, and the duplicated rows left by earlier runs are removed.
 
     Parameters:
-    - powerbi_data (pd.DataFrame): PowerBI CSV data.
-    - pd_chunks (pd.DataFrame): Existing chunks dataframe.
-    - files_tracker (pd.DataFrame): Existing files tracker dataframe.
+    - files_tracker (FilesTracker): Existing files tracker.
+    - record_ids (pd.Series): The Record IDs of the PowerBI data.
+    - changed_ids (Set[str]): The Record IDs whose chunks were added or modified.
 
     Returns:
-    Tuple[pd.DataFrame, pd.DataFrame]: Updated chunks dataframe and files tracker dataframe.
+    None
     """
 
-    num_new = num_update = 0
-    for i, row in powerbi_data.iterrows():
-
-        v_file_hash = row["Record ID"]
-        v_file_name = f"{row['Type']}, \
-                {row['Location formatted']}, \
-                {row['Contact Name']}, \
-                {row['Entity Name']}"
-
-        v_page = 0
-        v_level = 0
-        v_type = "PowerBI"
-
-        # Add a new line to the file tracker
-
-        new_row = {
-            "file_hash": v_file_hash,
-            "file_name": f"PowerBI_{str(row['Record ID'])}",
+    num_removed = files_tracker.drop_duplicates(["file_hash", "file_name"])
+
+    current_ids = set(record_ids.astype(str))
+    known_ids = set()
+    num_vanished = 0
+
+    for file in files_tracker.itertuples():
+        if not str(file.file_name).startswith("PowerBI_"):
+            continue
+
+        file_hash = str(file.file_hash)
+        known_ids.add(file_hash)
+
+        present = file_hash in current_ids
+        if file.present_in_last_update != present:
+            files_tracker.set(file.Index, "present_in_last_update", present)
+        if not present:
+            num_vanished += 1
+
+        if file_hash in changed_ids and (file.embedded or file.indexed):
+            files_tracker.set(file.Index, "embedded", False)
+            files_tracker.set(file.Index, "indexed", False)
+
+    # Add a new line to the file tracker for each unseen record
+    new_ids = [
+        record_id
+        for record_id in record_ids.drop_duplicates()
+        if str(record_id) not in known_ids
+    ]
+    files_tracker.extend(
+        {
+            "file_hash": record_id,
+            "file_name": f"PowerBI_{str(record_id)}",
             # "file_creation_time": file_creation_time,
             "present_in_last_update": True,
             "parsed": True,
             "embedded": False,
             "indexed": False,
         }
+        for record_id in new_ids
+    )
+
+    print(
+        f"Files tracker: {len(new_ids)} records added, {num_vanished} records not present, "
+        f"{num_removed} duplicated rows removed"
+    )
+
 
-        files_tracker = pd.concat(
-            [files_tracker, pd.DataFrame([new_row])], ignore_index=True
-        )
-
-        # print(v_file_hash, v_file_name, v_page, v_level, v_type)
-
-        for col_name in powerbi_data.columns[5:]:
-            v_header = col_name.replace("_", " ")
-            v_chunk = row[col_name]
-
-            if v_chunk == None or v_chunk == "" or str(v_chunk) == "nan":
-                continue
-
-            probe = pd_chunks.index[
-                    (pd_chunks['file_hash'] == str(v_file_hash)) &
-                    (pd_chunks['file_name'] == v_file_name) &
-                    (pd_chunks['header'] == v_header)
-                    ].tolist()
-
-            if len(probe) > 0:
-                # print("The line already exists, we only update the Chunk", probe)
-                pd_chunks.loc[probe,'chunk'] = v_chunk
-                num_update += 1
-
-            else:
-                # print("The line doesn't exists, we add it to the DF")
-
-                new_line = pd.DataFrame([{
-                    "file_hash": str(v_file_hash),
-                    "file_name": v_file_name,
-                    "page": v_page,
-                    "level": v_level,
-                    "type": v_type,
-                    "header": v_header,
-                    "chunk": v_chunk,
-                    "bloc": None
-                }])
-
-                pd_chunks = pd.concat(
-                     [pd_chunks, new_line], axis="index", ignore_index=True
-                )
-                # pd_chunks = pd.concat(
-                #     [
-                #         pd_chunks.astype(new_line.dtypes),
-                #         new_line.astype(pd_chunks.dtypes)
-                #     ], axis="index", ignore_index=True
-                # )
-
-                num_new += 1
+@task(name="PowerBI Parse CSV", log_prints=True)
+def PBI_parse_csv( powerbi_data: pd.DataFrame, pd_chunks: pd.DataFrame, files_tracker: FilesTracker) -> Tuple[pd.DataFrame, FilesTracker]:
+    """
+    Task to parse PowerBI CSV data and update the chunks dataframe.
+
+    Parameters:
+    - powerbi_data (pd.DataFrame): PowerBI CSV data.
+    - pd_chunks (pd.DataFrame): Existing chunks dataframe.
+    - files_tracker (FilesTracker): Existing files tracker.
 
+    Returns:
+    Tuple[pd.DataFrame, FilesTracker]: Updated chunks dataframe and files tracker.
+    """
+
+    keys = ["file_hash", "file_name", "header"]
+
+    # One row per (record, column), in the order of the records then of the columns
+    records = pd.DataFrame(
+        {
+            "file_hash": powerbi_data["Record ID"].astype(str),
+            "file_name": powerbi_data["Type"].astype(str)
+            + PBI_FILE_NAME_SEPARATOR
+            + powerbi_data["Location formatted"].astype(str)
+            + PBI_FILE_NAME_SEPARATOR
+            + powerbi_data["Contact Name"].astype(str)
+            + PBI_FILE_NAME_SEPARATOR
+            + powerbi_data["Entity Name"].astype(str),
+        }
+    )
+    records = records.join(powerbi_data[powerbi_data.columns[5:]])
+
+    new_chunks = records.melt(
+        id_vars=["file_hash", "file_name"],
+        var_name="header",
+        value_name="chunk",
+        ignore_index=False,
+    ).sort_index(kind="stable")
+    new_chunks["header"] = new_chunks["header"].str.replace("_", " ")
+
+    empty = new_chunks["chunk"].isna() | new_chunks["chunk"].astype(str).isin(["", "nan"])
+    new_chunks = new_chunks[~empty].drop_duplicates(subset=keys, keep="last")
+
+    # Update the chunks of the existing lines
+    pd_chunks = pd_chunks.reset_index(drop=True)
+    existing = pd_chunks[keys].astype(str)
+    merged = existing.merge(new_chunks, on=keys, how="left", indicator=True)
+    updated = (merged["_merge"] == "both").to_numpy()
+    changed = updated & (
+        pd_chunks["chunk"].astype(str).to_numpy() != merged["chunk"].astype(str).to_numpy()
+    )
+    pd_chunks.loc[updated, "chunk"] = merged.loc[updated, "chunk"].to_numpy()
+    changed_ids = set(pd_chunks.loc[changed, "file_hash"].astype(str))
+
+    # Add the lines that don't exist yet
+    probe = new_chunks.merge(existing.drop_duplicates(), on=keys, how="left", indicator=True)
+    added = new_chunks[(probe["_merge"] == "left_only").to_numpy()]
+
+    num_update = len(new_chunks) - len(added)
+    num_new = len(added)
+
+    pd_chunks = pd.concat(
+        [
+            pd_chunks,
+            added.assign(page=0, level=0, type="PowerBI", bloc=None).loc[:, pd_chunks.columns],
+        ],
+        axis="index",
+        ignore_index=True,
+    )
 
     print(f"{num_new} rows were added, {num_update} rows were updated")
 
+    # Update the file tracker, the records with new or modified chunks must be embedded again
+    changed_ids |= set(added["file_hash"])
+    PBI_update_tracker(files_tracker, powerbi_data["Record ID"], changed_ids)
+
     pd_chunks.drop_duplicates(inplace=True)
     return pd_chunks, files_tracker
 
 
 @flow(log_prints=True)
-def omdena_ungdc_etl_powerbi_csv_parsing_parent(max_doc: Optional[int] = None) -> None:
+def omdena_ungdc_etl_powerbi_csv_parsing_parent(
+    max_doc: Optional[int] = None,
+    tracker_backend: str = "csv",
+    chunks_backend: str = "csv",
+) -> None:
     """
     Prefect flow for orchestrating PowerBI CSV parsing.
 
     Parameters:
     - max_doc (Optional[int]): The maximum number of documents to process.
+    - tracker_backend (str): The files tracker backend, "csv" or "sqlite".
+    - chunks_backend (str): The chunks store backend, "csv" or "parquet".
 
     Returns:
     None
@@ -150,44 +214,28 @@ def omdena_ungdc_etl_powerbi_csv_parsing_parent(max_doc: Optional[int] = None) -
     if not os.path.exists(local_dir):
         raise Exception("The source folder doesn't exist")
 
-    files_tracker_path = Path(local_dir, "files_tracker.csv")
-    if not os.path.exists(files_tracker_path):
-        read_AWS(files_tracker_path, files_tracker_path, bucket_block)
-    files_tracker = pd.read_csv(files_tracker_path)
-
-    # Define the file to save the chunks
-    pd_chunk_path = Path(local_dir, "extracted_chunks.csv")
-    if not os.path.exists(pd_chunk_path):
-        read_AWS(pd_chunk_path, pd_chunk_path, bucket_block)
-
-    if os.path.exists(pd_chunk_path):
-        pd_chunks = pd.read_csv(pd_chunk_path)
-    else:
-        columns = [
-            "file_hash",
-            "file_name",
-            "page",
-            "level",
-            "type",
-            "header",
-            "chunk",
-            "bloc",
-        ]
-        pd_chunks = pd.DataFrame(columns=columns)
+    files_tracker = open_files_tracker(local_dir, bucket_block, tracker_backend)
+
+    # Define the store to save the chunks
+    chunks_store = open_chunks_store(local_dir, bucket_block, chunks_backend)
 
     # Load PowerBI.csv
     powerbi_path = Path(local_dir, "powerBI.csv")
     powerbi_data = pd.read_csv(powerbi_path)
 
+    # Load the chunks of the PowerBI records only
+    pd_chunks = chunks_store.load(file_hashes=powerbi_data["Record ID"].unique())
+
     # Add CSV rows to the Chunks dataframe
     pd_chunks, files_tracker = PBI_parse_csv(powerbi_data, pd_chunks, files_tracker)
 
     # Save
-    pd_chunks.to_csv(pd_chunk_path, index=False)
-    files_tracker.to_csv(files_tracker_path, index=False)
+    chunks_store.put(pd_chunks)
+    files_tracker.save()
 
-    write_AWS(files_tracker_path, files_tracker_path, bucket_block)
-    write_AWS(pd_chunk_path, pd_chunk_path, bucket_block)
+    write_AWS(files_tracker.path, files_tracker.path, bucket_block)
+    for path in chunks_store.save():
+        write_AWS(path, path, bucket_block)
 
 
 if __name__ == "__main__":
@@ -19,8 +19,10 @@ ETL Script for Scraping UN Power BI Dashboard
 This script defines the Prefect flow for scraping data from the UN Power BI dashboard.
 
 Functions:
+- query_all_pages: Runs a Power BI query page by page, following the restart tokens.
 - page_1_scraping: Task to scrape data from page 1 of the Power BI dashboard.
-- page_2_scraping: Task to scrape data from page 2 of the Power BI dashboard and merge it with existing data.
+- page_2_scraping: Task to scrape data from page 2 of the Power BI dashboard (one concurrent query per topic)
+  and merge it with existing data.
 
 Flow:
 - omdena_ungdc_etl_scrap_pbi_parent: Prefect flow for scraping data from the UN Power BI dashboard.
@@ -35,22 +37,109 @@ Returns:
 None
 """
 
+import copy
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
 from prefect import flow, task
 from prefect_aws import S3Bucket
+from prefect.utilities.annotations import quote
 
-from etl_common import write_AWS
+from etl_common import write_AWS, create_session
+from etl_cache import ResponseCache
 
 import pandas as pd
 from json_to_csv import extract
 
 
+# Number of rows requested per page of a Power BI query
+WINDOW_COUNT = 500
+
+
+def query_all_pages(
+    api_url: str,
+    payload: Dict[str, Any],
+    headers: Dict[str, str],
+    window_count: int = WINDOW_COUNT,
+    max_pages: int = 1000,
+    session: Optional[requests.Session] = None,
+    cache: Optional[ResponseCache] = None,
+) -> pd.DataFrame:
+    """
+    Runs a Power BI query page by page and concatenates the results.
+
+    The query is windowed (`window_count` rows per page); as long as the response contains
+    restart tokens ("RT"), they are sent back to get the next page. Each page is converted
+    to a DataFrame as soon as it is received, so only one raw response is held at a time.
+
+    Parameters:
+    - api_url (str): The API URL for the Power BI dashboard.
+    - payload (Dict[str, Any]): The JSON payload for the API request (it isn't modified).
+    - headers (Dict[str, str]): The headers for the API request.
+    - window_count (int): The number of rows per page.
+    - max_pages (int): The maximum number of pages to request.
+    - session (Optional[requests.Session]): The HTTP session to use (a new connection per request otherwise).
+    - cache (Optional[ResponseCache]): The cache of the Power BI responses (each page is cached separately).
+
+    Returns:
+    - pd.DataFrame: The rows of all the pages.
+    """
+
+    payload = copy.deepcopy(payload)
+    command = payload["queries"][0]["Query"]["Commands"][0]
+    window = {"Count": window_count}
+    command["SemanticQueryDataShapeCommand"]["Binding"]["DataReduction"]["Primary"] = {
+        "Window": window
+    }
+
+    frames = []
+    for page in range(max_pages):
+        key = cache.key(api_url, payload) if cache is not None else None
+        result = cache.get(key) if cache is not None else None
+
+        if result is None:
+            response = (session or requests).post(api_url, json=payload, headers=headers)
+            response.raise_for_status()
+            result = response.json()
+
+            # Don't cache the error payloads, so that the next run queries the dashboard again
+            try:
+                result["results"][0]["result"]["data"]["dsr"]
+            except (KeyError, IndexError, TypeError):
+                raise Exception(f"Unexpected Power BI response: {str(result)[:500]}")
+
+            if cache is not None:
+                cache.put(key, result)
+
+        ds = result["results"][0]["result"]["data"]["dsr"]["DS"][0]
+        if len(ds["PH"][0].get("DM0", [])) > 0:
+            frames.append(extract(result))
+
+        restart_tokens = ds.get("RT")
+        if not restart_tokens:
+            break
+
+        print(f"Page {page + 1} received, requesting the next one")
+        window["RestartTokens"] = restart_tokens
+
+    else:
+        print(f"Warning: the query was truncated after {max_pages} pages")
+
+    if len(frames) == 0:
+        raise Exception("The Power BI query didn't return any row")
+
+    return pd.concat(frames, ignore_index=True)
+
+
 @task(name="Scrap page 1", log_prints=True)
 def page_1_scraping(
-    api_url: str, payload: Dict[str, Any], headers: Dict[str, str]
+    api_url: str,
+    payload: Dict[str, Any],
+    headers: Dict[str, str],
+    window_count: int = WINDOW_COUNT,
+    cache: Optional[ResponseCache] = None,
 ) -> pd.DataFrame:
     """
     Task to scrape data from page 1 of the Power BI dashboard.
@@ -59,6 +148,8 @@ def page_1_scraping(
     - api_url (str): The API URL for the Power BI dashboard.
     - payload (Dict[str, Any]): The JSON payload for the API request.
     - headers (Dict[str, str]): The headers for the API request.
+    - window_count (int): The number of rows per page of the query.
+    - cache (Optional[ResponseCache]): The cache of the Power BI responses.
 
     Returns:
     - pd.DataFrame: The scraped data from page 1.
@@ -66,13 +157,18 @@ def page_1_scraping(
 
     print(">>> MAIN TABLE")
 
-    table_data = requests.post(api_url, json=payload, headers=headers).json()
-    return extract(table_data)
+    return query_all_pages(api_url, payload, headers, window_count, cache=cache)
 
 
 @task(name="Scrap page 2", log_prints=True)
 def page_2_scraping(
-    api_url: str, payload_p2: Dict[str, Any], headers: Dict[str, str], df: pd.DataFrame
+    api_url: str,
+    payload_p2: Dict[str, Any],
+    headers: Dict[str, str],
+    df: pd.DataFrame,
+    window_count: int = WINDOW_COUNT,
+    max_workers: int = 8,
+    cache: Optional[ResponseCache] = None,
 ) -> pd.DataFrame:
     """
     Task to scrape data from page 2 of the Power BI dashboard and merge it with existing data.
@@ -82,6 +178,9 @@ def page_2_scraping(
     - payload_p2 (Dict[str, Any]): The JSON payload for the API request for page 2.
     - headers (Dict[str, str]): The headers for the API request.
     - df (pd.DataFrame): The existing DataFrame.
+    - window_count (int): The number of rows per page of the queries.
+    - max_workers (int): The maximum number of topics queried concurrently.
+    - cache (Optional[ResponseCache]): The cache of the Power BI responses.
 
     Returns:
     - pd.DataFrame: The DataFrame with additional columns scraped from page 2.
@@ -101,19 +200,33 @@ def page_2_scraping(
         "Regulation of AI",
     ]
 
-    # POPULATE TOPICS
-    for topic in topics:
+    # QUERY TOPICS
+    # Each topic gets its own copy of the payload, the queries share the HTTP session
+    def query_topic(topic: str) -> Tuple[str, pd.DataFrame]:
         print(">>> TOPIC:", topic)
-        clean_topic = topic.replace(" ", "_").replace("/", "_")
 
-        payload_p2["queries"][0]["Query"]["Commands"][0][
-            "SemanticQueryDataShapeCommand"
-        ]["Query"]["Where"][0]["Condition"]["In"]["Values"][0][0]["Literal"][
+        payload = copy.deepcopy(payload_p2)
+        payload["queries"][0]["Query"]["Commands"][0]["SemanticQueryDataShapeCommand"][
+            "Query"
+        ]["Where"][0]["Condition"]["In"]["Values"][0][0]["Literal"][
             "Value"
         ] = f"'{topic}'"
 
-        result = requests.post(api_url, json=payload_p2, headers=headers).json()
-        query_df = extract(result)
+        return topic, query_all_pages(
+            api_url, payload, headers, window_count, session=session, cache=cache
+        )
+
+    max_workers = max(1, max_workers)
+
+    # The session keeps one connection per worker, so the queries don't wait for a free connection
+    with create_session(max_workers, headers) as session:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(query_topic, topics))
+
+    # POPULATE TOPICS
+    rights = []
+    for topic, query_df in results:
+        clean_topic = topic.replace(" ", "_").replace("/", "_")
 
         # Merge the `Core Principles` and `Commitments, pledges or actions` columns with the existing DF
         cols = ["Record ID", "Core Principles", "Commitments, pledges or actions"]
@@ -125,29 +238,38 @@ def page_2_scraping(
             },
             inplace=True,
         )
-
-        left = df.set_index("Record ID", drop=False)
-        right = tmp_df.set_index("Record ID", drop=True)
-        df = left.join(right, how="left", lsuffix="", rsuffix=f"__{clean_topic}")
+        rights.append(tmp_df.set_index("Record ID", drop=True))
 
     else:
         print(">>> PROCESS DESCRIPTION")
-        # Merge the `Process description` column on the last call
-        left = df.set_index("Record ID", drop=False)
-
+        # Merge the `Process description` column of the last topic
         tmp_df = query_df.loc[:, ["Record ID", "Process description"]]
-        right = tmp_df.set_index("Record ID", drop=True)
+        rights.append(tmp_df.set_index("Record ID", drop=True))
 
-        df = left.join(right, how="left", lsuffix="", rsuffix=f"")
+    # Merge all the topics at once
+    left = df.set_index("Record ID", drop=False)
+    df = left.join(rights, how="left")
 
     return df
 
 
 @flow(log_prints=True)
-def omdena_ungdc_etl_scrap_pbi_parent() -> None:
+def omdena_ungdc_etl_scrap_pbi_parent(
+    window_count: int = WINDOW_COUNT,
+    max_workers: int = 8,
+    cache_ttl: Optional[int] = 3600,
+    offline: bool = False,
+) -> None:
     """
     Prefect flow for scraping data from the UN Power BI dashboard.
 
+    Parameters:
+    - window_count (int): The number of rows per page of the Power BI queries.
+    - max_workers (int): The maximum number of Power BI queries sent concurrently.
+    - cache_ttl (Optional[int]): The lifetime (in seconds) of the cached Power BI responses
+      (0 disables the cache, None keeps the responses until they are evicted).
+    - offline (bool): Replay the cached Power BI responses only, without any network access.
+
     Returns:
     None
     """
@@ -500,8 +622,7 @@ def omdena_ungdc_etl_scrap_pbi_parent() -> None:
                                     # "Primary": {"Groupings": [{"Projections": [0]}]},
                                     "DataReduction": {
                                         "DataVolume": 3,
-                                        "Primary": {"Top": {}},
-                                        # "Primary": {"Window": {"Count": 500}},
+                                        "Primary": {"Window": {"Count": 500}},
                                     },
                                     "Version": 1,
                                 },
@@ -534,9 +655,16 @@ def omdena_ungdc_etl_scrap_pbi_parent() -> None:
         "X-Powerbi-Resourcekey": "84db278f-178b-4a18-a0db-3e57e8113b1f",
     }
 
+    # cache of the raw responses, to make the reruns (and the offline replays) near-instant
+    cache = None
+    if cache_ttl != 0 or offline:
+        cache = ResponseCache(
+            Path("data", "cache", "powerbi"), ttl=cache_ttl, offline=offline
+        )
+
     ##### START SCRAPING P1 #####
 
-    df = page_1_scraping(api_url, payload_p1, headers)
+    df = page_1_scraping(api_url, payload_p1, headers, window_count, quote(cache))
 
     ##### SET RECORD IDS #####
 
@@ -555,13 +683,19 @@ def omdena_ungdc_etl_scrap_pbi_parent() -> None:
 
     local_dir = "data"
     export_path = Path(local_dir, "powerBI.csv")
-    df = page_2_scraping(api_url, payload_p2, headers, df)
+    df = page_2_scraping(
+        api_url, payload_p2, headers, df, window_count, max_workers, quote(cache)
+    )
     df.to_csv(export_path, index=False)
 
     print("Scrapping completed")
 
 
     #### SAVE FILE TO AWS S3 #####
+    if offline:
+        print("Offline replay, the file isn't uploaded to AWS S3")
+        return
+
     bucket_block = S3Bucket.load("omdena-un-gdc-bucket")
     write_AWS(export_path, export_path, bucket_block)
 
@@ -9,7 +9,7 @@ The flow includes tasks for retrieving HTML code, extracting file URLs, download
 Tasks:
 - Get HTML code: Connects to a specified URL and retrieves the HTML code.
 - Extract files URLs from HTML: Finds file URLs in the provided HTML code.
-- Write Data Locally: Downloads the provided remote file locally and returns local file paths.
+- Write Data Locally (concurrent): Downloads several remote files with a bounded pool of workers.
 - get_info: Extracts creation date information from a PDF file.
 
 Prefect Flow:
@@ -18,7 +18,9 @@ Prefect Flow:
   - Retrieves HTML code from the source URL.
   - Extracts file URLs from the HTML code.
   - Reads the existing file tracking CSV from AWS S3.
-  - Iterates through each file, downloading and uploading it, and updating the file tracking CSV.
+  - Downloads the files concurrently (bounded by `max_workers`) with a shared HTTP session,
+    using conditional requests (ETag / Last-Modified) to skip the files that didn't change.
+  - Iterates through each downloaded file, uploading it and updating the file tracking CSV.
 
 Note: Ensure that the 'requests', 'hashlib', 'pathlib', 'PyPDF2', 'pandas', 'prefect', and 'prefect_aws' packages are installed for proper execution.
 """
@@ -28,8 +30,9 @@ import os
 import requests
 import hashlib
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import Any, Dict, Iterable, List, Optional
 
 # from datetime import timedelta
 
@@ -42,12 +45,16 @@ from prefect_aws import S3Bucket
 
 # from prefect.tasks import task_input_hash
 
-from etl_common import read_AWS, write_AWS, get_arguments
+from etl_common import write_AWS, create_session, get_arguments
+from etl_files_tracker import FilesTracker, open_files_tracker
 
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36",
 }
 
+# Size of the chunks streamed from the source to the local files (1 MiB)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 @task(
     name="Get HTML code",
@@ -117,46 +124,191 @@ def generate_hash(contents: bytes) -> str:
     return hash_object.hexdigest()
 
 
-@task(
-    name="Write Data Locally",
-    log_prints=True,
-    # cache_key_fn=task_input_hash,
-    # cache_expiration=timedelta(days=1),
-)
-def write_local(
-    base_url: str, file_name: str, local_dir: Path
-) -> Tuple[Path, Path, str]:
+def stream_to_file(chunks: Iterable[bytes], file_path: Path) -> str:
     """
-    Task to download the provided remote file locally.
+    Writes the given chunks to a file while computing their SHA-256 hash in the same pass.
 
     Parameters:
+    - chunks (Iterable[bytes]): The contents to write, chunk by chunk.
+    - file_path (Path): The path of the file to write.
+
+    Returns:
+    str: The hexadecimal representation of the hash of the whole contents.
+    """
+
+    hash_object = hashlib.sha256()
+
+    try:
+        with open(file_path, "wb") as f:
+            for chunk in chunks:
+                hash_object.update(chunk)
+                f.write(chunk)
+
+    except Exception:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+
+    return hash_object.hexdigest()
+
+
+def download_file(
+    session: requests.Session,
+    base_url: str,
+    file_name: str,
+    local_dir: Path,
+    validators: Optional[Dict[str, str]] = None,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+) -> Optional[Dict[str, Any]]:
+    """
+    Downloads the provided remote file to a temporary local file.
+
+    The response is streamed: each chunk is hashed and written as it arrives,
+    so the memory used does not depend on the size of the file.
+
+    When validators from a previous download are provided, the request is made conditional
+    (If-None-Match / If-Modified-Since) so that an unchanged file only costs a 304 response.
+
+    Parameters:
+    - session (requests.Session): The HTTP session used for the request.
     - base_url (str): The base URL for the files.
     - file_name (str): The name of the file to download.
     - local_dir (Path): The local directory to store the downloaded file.
+    - validators (Optional[Dict[str, str]]): The 'etag' and/or 'last_modified' values of the previous download.
+    - chunk_size (int): The size (in bytes) of the streamed chunks.
 
     Returns:
-    Tuple[Path, Path, str]: Tuple containing local file path, temporary file path, and file hash.
+    Optional[Dict[str, Any]]: The download infos (local_path, tmp_path, file_hash, etag, last_modified,
+    content_length, not_modified), or None if the download failed.
     """
 
     try:
         file_path = f"{base_url}{file_name}"
         print("Download from source:", file_path)
 
-        r = requests.get(file_path, allow_redirects=True, headers=headers)
-        file_hash = generate_hash(r.content)
-
-        local_path = Path(local_dir, file_name)
-        tmp_path = Path(local_dir, f"{file_name}.tmp")
-
-        with open(tmp_path, "wb") as f:
-        	f.write(r.content)
+        request_headers = {}
+        if validators:
+            if validators.get("etag"):
+                request_headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                request_headers["If-Modified-Since"] = validators["last_modified"]
+
+        r = session.get(
+            file_path, allow_redirects=True, headers=request_headers, stream=True
+        )
+
+        infos = {
+            "local_path": Path(local_dir, file_name),
+            "tmp_path": None,
+            "file_hash": None,
+            "etag": r.headers.get("ETag", (validators or {}).get("etag")),
+            "last_modified": r.headers.get(
+                "Last-Modified", (validators or {}).get("last_modified")
+            ),
+            "content_length": r.headers.get("Content-Length"),
+            "not_modified": r.status_code == 304,
+        }
+
+        with r:
+            if infos["not_modified"]:
+                print("Not modified since the last download:", file_path)
+                return infos
+
+            r.raise_for_status()
+            infos["tmp_path"] = Path(local_dir, f"{file_name}.tmp")
+            infos["file_hash"] = stream_to_file(
+                r.iter_content(chunk_size=chunk_size), infos["tmp_path"]
+            )
 
-        return local_path, tmp_path, file_hash
+        return infos
 
     except Exception as e:
         print(e, file_name)
 
 
+@task(name="Write Data Locally (concurrent)", log_prints=True)
+def write_local_concurrent(
+    base_url: str,
+    files_names: List[str],
+    local_dir: Path,
+    max_workers: int = 8,
+    files_validators: Optional[Dict[str, Dict[str, str]]] = None,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+) -> List[Optional[Dict[str, Any]]]:
+    """
+    Task to download the provided remote files locally using a bounded pool of workers.
+
+    The workers share a single HTTP session, so the connections to the source are reused
+    instead of being re-opened for each file.
+
+    Parameters:
+    - base_url (str): The base URL for the files.
+    - files_names (List[str]): The names of the files to download.
+    - local_dir (Path): The local directory to store the downloaded files.
+    - max_workers (int): The maximum number of concurrent downloads.
+    - files_validators (Optional[Dict[str, Dict[str, str]]]): The validators of the previous downloads, by file name.
+    - chunk_size (int): The size (in bytes) of the streamed chunks.
+
+    Returns:
+    List[Optional[Dict[str, Any]]]: For each file (in the input order), the download infos
+    (see `download_file`), or None if the download failed.
+    """
+
+    max_workers = max(1, min(max_workers, len(files_names)))
+    files_validators = files_validators or {}
+
+    with create_session(max_workers, headers) as session:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(
+                lambda file_name: download_file(
+                    session,
+                    base_url,
+                    file_name,
+                    local_dir,
+                    files_validators.get(file_name),
+                    chunk_size,
+                ),
+                files_names,
+            )
+            return list(results)
+
+
+def get_files_validators(
+    files_tracker: FilesTracker, local_dir: str
+) -> Dict[str, Dict[str, str]]:
+    """
+    Collects the HTTP validators (ETag / Last-Modified) of the last download of each file.
+
+    Validators are only returned for files that don't need to be downloaded again for the next steps
+    (i.e. already parsed, or still available locally), so that a 304 never leaves a flow without its file.
+
+    Parameters:
+    - files_tracker (FilesTracker): The files tracker.
+    - local_dir (str): The local directory where the files are stored.
+
+    Returns:
+    Dict[str, Dict[str, str]]: The validators ('etag' and/or 'last_modified'), by file name.
+    """
+
+    files_validators = {}
+    for file in files_tracker.itertuples():
+        validators = {
+            key: getattr(file, key, None)
+            for key in ["etag", "last_modified"]
+            if not pd.isna(getattr(file, key, None))
+        }
+        needs_file = file.parsed is not True and not os.path.exists(
+            Path(local_dir, file.file_name)
+        )
+
+        if validators and not needs_file:
+            files_validators[file.file_name] = validators
+        else:
+            files_validators.pop(file.file_name, None)
+
+    return files_validators
+
+
 # def get_info(path: Path) -> Optional[str]:
 #     """
 #     Task to extract creation date information from a PDF file.
@@ -184,12 +336,16 @@ def write_local(
 
 
 @flow(log_prints=True)
-def omdena_ungdc_etl_web_to_aws_parent(max_doc: int = None) -> None:
+def omdena_ungdc_etl_web_to_aws_parent(
+    max_doc: int = None, max_workers: int = 8, tracker_backend: str = "csv"
+) -> None:
     """
     Prefect flow for collecting files from a source URL and uploading them to AWS S3.
 
     Parameters:
     - max_doc (int): The maximum number of documents to process
+    - max_workers (int): The maximum number of concurrent downloads
+    - tracker_backend (str): The files tracker backend, "csv" or "sqlite"
 
     Returns:
     None
@@ -209,33 +365,62 @@ def omdena_ungdc_etl_web_to_aws_parent(max_doc: int = None) -> None:
     html_code = get_html(source_url)
     files = get_files_uris(html_code, base_files)
 
-    files_tracker_path = Path("data", "files_tracker.csv")
-    if not os.path.exists(files_tracker_path):
-        read_AWS(files_tracker_path, files_tracker_path, bucket_block)
+    # The same file can be linked several times, download each one once
+    files = list(dict.fromkeys(files))
 
-    if os.path.exists(files_tracker_path):
-        files_tracker = pd.read_csv(files_tracker_path)
-        files_tracker["present_in_last_update"] = False
-    else:
-        columns = [
-            "file_hash",
-            "file_name",
-            "file_creation_time",
-            "present_in_last_update",
-            "parsed",
-            "embedded",
-            "indexed",
-        ]
-        files_tracker = pd.DataFrame(columns=columns)
-
-    for i, file_name in enumerate(files):
-        local_path, tmp_path, file_hash = write_local(base_files, file_name, local_dir)
-
-        if file_hash in files_tracker["file_hash"].values:
+    files_tracker = open_files_tracker(local_dir, bucket_block, tracker_backend)
+    files_tracker.add_columns(["etag", "last_modified", "content_length"])
+
+    if max_doc is not None:
+        files = files[:max_doc]
+
+    files_validators = get_files_validators(files_tracker, local_dir)
+    downloads = write_local_concurrent(
+        base_files, files, local_dir, max_workers, files_validators
+    )
+
+    # The files found by this run (the others are flagged as absent once all the files are processed)
+    present = set()
+
+    for i, (file_name, download) in enumerate(zip(files, downloads)):
+        if download is None:
+            print(i, f"{file_name} couldn't be downloaded")
+
+            # The file is still listed by the source, it keeps the flag of the previous run
+            file_index = files_tracker.index_of_file_name(file_name)
+            if file_index is not None:
+                present.add(file_index)
+            continue
+
+        local_path = download["local_path"]
+        tmp_path = download["tmp_path"]
+        file_hash = download["file_hash"]
+        validators = {
+            "etag": download["etag"],
+            "last_modified": download["last_modified"],
+            "content_length": download["content_length"],
+        }
+
+        if download["not_modified"]:
+            print(i, "This file wasn't modified since its last download")
+
+            file_index = files_tracker.index_of_file_name(file_name)
+            files_tracker.set(file_index, "present_in_last_update", True)
+            present.add(file_index)
+
+            # A 304 may omit some headers (e.g. Content-Length), keep the values of the last download
+            for key, value in validators.items():
+                if value is not None:
+                    files_tracker.set(file_index, key, value)
+
+        elif file_hash in files_tracker:
             print(i, "This file_hash already exists in the files_tracker CSV")
 
-            file_index = files_tracker.index[files_tracker["file_hash"] == file_hash][0]
-            files_tracker.at[file_index, "present_in_last_update"] = True
+            file_index = files_tracker.index_of(file_hash)
+            files_tracker.set(file_index, "present_in_last_update", True)
+            present.add(file_index)
+            for key, value in validators.items():
+                files_tracker.set(file_index, key, value)
 
             if os.path.exists(local_path):
                 os.remove(tmp_path)
@@ -256,18 +441,19 @@ def omdena_ungdc_etl_web_to_aws_parent(max_doc: int = None) -> None:
                 "parsed": False,
                 "embedded": False,
                 "indexed": False,
+                **validators,
             }
 
-            files_tracker = pd.concat(
-                [files_tracker, pd.DataFrame([new_row])], ignore_index=True
-            )
+            present.add(files_tracker.append(new_row))
             write_AWS(local_path, local_path, bucket_block)
 
-        if max_doc is not None and i + 1 >= max_doc:
-            break
+    # Flag the files missing from this run, in a single update once the downloads are done
+    # (a crash before this point leaves the flags of the previous run)
+    missing = [file.Index for file in files_tracker.itertuples() if file.Index not in present]
+    files_tracker.set_many(missing, "present_in_last_update", False)
 
-    files_tracker.to_csv(files_tracker_path, index=False)
-    write_AWS(files_tracker_path, files_tracker_path, bucket_block)
+    files_tracker.save()
+    write_AWS(files_tracker.path, files_tracker.path, bucket_block)
 
 
 if __name__ == "__main__":
@@ -7,6 +7,8 @@ This script provides functions to convert the JSON output of a PowerBI query to
 
 Functions:
 - extract: Converts the JSON output to a DataFrame and saves it as a CSV file.
+- decode_columns: Decodes the data in a single pass (arrays reconstruction, values expansion
+                  and newlines replacement) into columns.
 - to_dataframe: Converts the data to a pandas DataFrame.
 - reconstruct_arrays: Fixes array index by applying "R" bitset to copy previous values
                      and "Ø" bitset to set null values.
@@ -55,11 +57,66 @@ def extract(input_json: Dict[str, Any]) -> pd.DataFrame:
         columns.append(col)
     value_dicts = data["dsr"]["DS"][0].get("ValueDicts", {})
 
-    reconstruct_arrays(columns_types, dm0)
-    expand_values(columns_types, dm0, value_dicts)
+    decoded = decode_columns(columns_types, dm0, value_dicts, "")
 
-    replace_newlines_with(dm0, "")
-    return to_dataframe(columns, dm0)
+    # Build the rows from the positions of the columns (several columns can have the same name)
+    return pd.DataFrame(list(zip(*decoded)), columns=columns, dtype=object)
+
+
+def decode_columns(
+    columns_types: List[Dict[str, Any]],
+    dm0: List[Dict[str, Any]],
+    value_dicts: Dict[str, List[Optional[str]]],
+    replacement: str,
+) -> List[List[Any]]:
+    """
+    Decodes the data in a single pass, into columns.
+
+    For each row, this does what `reconstruct_arrays`, `expand_values` and `replace_newlines_with`
+    do in three passes: the "R" (copy previous value) and "Ø" (null value) bitsets are applied
+    while filling a fixed-width row, then the value dictionaries indexes are substituted and
+    the newlines are replaced. Unlike these functions, dm0 is left untouched.
+
+    Parameters:
+    - columns_types (List[Dict[str, Any]]): The column types.
+    - dm0 (List[Dict[str, Any]]): The data.
+    - value_dicts (Dict[str, List[Optional[str]]]): The value dictionaries.
+    - replacement (str): The replacement for newlines.
+
+    Returns:
+    List[List[Any]]: The decoded values, column by column.
+    """
+
+    width = len(columns_types)
+    dicts = [value_dicts[col["DN"]] if "DN" in col else None for col in columns_types]
+    columns = [[] for _ in range(width)]
+
+    # The "R" bitset copies the raw (not yet expanded) values of the previous row
+    prev_raw = [None] * width
+    for item in dm0:
+        values = item["C"]
+        copy_bitset = item.get("R", 0)
+        delete_bitset = item.get("Ø", 0)
+
+        raw = [None] * width
+        position = 0
+        for i in range(width):
+            if (copy_bitset >> i) & 1:
+                raw[i] = prev_raw[i]
+            elif not (delete_bitset >> i) & 1 and position < len(values):
+                raw[i] = values[position]
+                position += 1
+
+        for i, value in enumerate(raw):
+            if dicts[i] is not None and isinstance(value, int):
+                value = dicts[i][value]
+            if isinstance(value, str):
+                value = value.replace("\n", replacement)
+            columns[i].append(value)
+
+        prev_raw = raw
+
+    return columns
 
 
 def to_dataframe(columns: List[str], dm0: List[Dict[str, Any]]) -> pd.DataFrame:
@@ -73,11 +130,10 @@ def to_dataframe(columns: List[str], dm0: List[Dict[str, Any]]) -> pd.DataFrame:
     Returns:
     pd.DataFrame: The DataFrame representing the data.
     """
-    data = pd.DataFrame({}, columns=columns)
-    for item in dm0:
-        data.loc[len(data)] = item["C"]
 
-    return data
+    # Build all the rows at once (appending them one by one with .loc is quadratic)
+    rows = [item["C"] for item in dm0]
+    return pd.DataFrame(rows, columns=columns, dtype=object)
 
 
 def reconstruct_arrays(
@@ -0,0 +1,85 @@
+"""
+Fake llmsherpa Parsing Server
+
+This script serves canned layout JSON in place of the llmsherpa / nlm-ingestor parsing API,
+so the llmsherpa parsing flow can be run and benchmarked offline.
+
+Every POST request is answered with the same blocks (the PDF file sent is read and ignored),
+after an optional delay simulating the parsing time.
+
+Usage:
+    python llmsherpa_fake_server.py --port 5010 --delay 0.5
+    LLMSHERPA_API_URL="http://localhost:5010/api/parseDocument?renderFormat=all" python flows/etl_llmserpa_pdf_parsing.py
+"""
+import json
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+BLOCKS = [
+    {"block_idx": 0, "page_idx": 0, "level": 0, "tag": "header", "sentences": ["Global Digital Compact"]},
+    {"block_idx": 1, "page_idx": 0, "level": 1, "tag": "para", "sentences": ["This submission is a canned layout returned by the fake parsing server."]},
+    {"block_idx": 2, "page_idx": 0, "level": 1, "tag": "header", "sentences": ["Connect all people to the internet"]},
+    {"block_idx": 3, "page_idx": 0, "level": 2, "tag": "para", "sentences": ["Universal and meaningful connectivity should be a priority."]},
+    {"block_idx": 4, "page_idx": 0, "level": 2, "tag": "list_item", "sentences": ["Affordable access for all."]},
+    {"block_idx": 5, "page_idx": 0, "level": 2, "tag": "list_item", "sentences": ["Digital skills for all."]},
+    {"block_idx": 6, "page_idx": 1, "level": 1, "tag": "header", "sentences": ["Protect data"]},
+    {"block_idx": 7, "page_idx": 1, "level": 2, "tag": "para", "sentences": ["Personal data must be protected across borders."]},
+]
+
+
+def make_handler(blocks, delay):
+    """
+    Creates the request handler answering every POST request with the given blocks.
+
+    Parameters:
+    - blocks (list): The layout blocks returned for every document.
+    - delay (float): The time spent on each request, in seconds.
+
+    Returns:
+    type: The request handler class.
+    """
+
+    response = json.dumps({"return_dict": {"result": {"blocks": blocks}}}).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            # Consume the uploaded file
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(delay)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+    return Handler
+
+
+def get_arguments():
+    """
+    Initialize the argparse module and return the expected arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Fake llmsherpa parsing server")
+    parser.add_argument("--host", default="localhost", help="The address to listen on")
+    parser.add_argument("--port", type=int, default=5010, help="The port to listen on")
+    parser.add_argument("--delay", type=float, default=0.0, help="The parsing time of each document, in seconds")
+    parser.add_argument("--blocks", default=None, help="A JSON file with the blocks to return (canned ones by default)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+
+    blocks = BLOCKS
+    if args.blocks is not None:
+        with open(args.blocks) as f:
+            blocks = json.load(f)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(blocks, args.delay))
+    print(f"Fake llmsherpa server listening on http://{args.host}:{args.port}")
+    server.serve_forever()
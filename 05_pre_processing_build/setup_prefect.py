@@ -37,7 +37,10 @@ def register_blocks():
     # --- Register Docker block
     docker_block = DockerContainer(
         # env={"EXTRA_PIP_PACKAGES": "s3fs prefect==2.14.12 pydantic==1.10.11 prefect-aws[S3]==0.4.6},
-        env={"WEAVIATE_URL":"http://weaviate:8080"},
+        env={
+            "WEAVIATE_URL": "http://weaviate:8080",
+            "LLMSHERPA_API_URL": os.environ.get("LLMSHERPA_API_URL", ""),  # parsing endpoints (comma-separated)
+        },
         networks=["prefect-network"],
         # image_registry="",
         image=config['prefect.Docker']['flows_image'],
@@ -0,0 +1,55 @@
+"""
+Tests of the chunks store (see flows/etl_chunks_store.py).
+"""
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows")
+)
+
+from etl_chunks_store import CHUNKS_BACKENDS, ParquetChunksStore, open_chunks_store
+
+
+class StubBucket:
+    """
+    Lists the given objects and records the downloads requested to the AWS-S3 bucket.
+    """
+
+    def __init__(self, keys=()) -> None:
+        self.keys = list(keys)
+        self.folders = []
+        self.objects = []
+
+    def list_objects(self, folder: str = ""):
+        return [{"Key": key} for key in self.keys if key.startswith(folder)]
+
+    def download_folder_to_path(self, from_folder: str, to_folder: str) -> None:
+        self.folders.append((from_folder, to_folder))
+
+    def download_object_to_path(self, from_path: str, to_path: str) -> None:
+        self.objects.append((from_path, to_path))
+
+
+def test_open_parquet_store_downloads_the_loaded_files_only(tmp_path):
+    path = str(tmp_path / CHUNKS_BACKENDS["parquet"])
+    bucket = StubBucket([f"{path}/aaa.parquet", f"{path}/bbb.parquet"])
+
+    chunks_store = open_chunks_store(tmp_path, bucket, backend="parquet")
+    assert isinstance(chunks_store, ParquetChunksStore)
+    assert chunks_store.file_hashes() == ["aaa", "bbb"]
+    assert bucket.folders == [] and bucket.objects == []
+
+    chunks_store.load(file_hashes=["bbb", "ccc"])
+
+    partition = str(chunks_store.partition_path("bbb"))
+    assert bucket.objects == [(partition, partition)]
+
+
+def test_open_parquet_store_seeds_an_empty_store_from_the_csv(tmp_path):
+    bucket = StubBucket()
+
+    open_chunks_store(tmp_path, bucket, backend="parquet")
+
+    csv_path = str(tmp_path / CHUNKS_BACKENDS["csv"])
+    assert bucket.objects == [(csv_path, csv_path)]
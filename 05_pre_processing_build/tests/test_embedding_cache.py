@@ -0,0 +1,60 @@
+"""
+Tests of the synchronization of the embedding cache with AWS-S3 (see flows/etl_common.py).
+"""
+import os
+import shutil
+import sys
+
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows")
+)
+
+from etl_cache import EmbeddingCache
+from etl_common import download_embedding_cache
+
+
+class FolderBucket:
+    """
+    AWS-S3 bucket stand-in serving the files of a local folder, and recording the downloads.
+    """
+
+    def __init__(self, root, local_root) -> None:
+        self.root = root
+        self.local_root = local_root
+        self.downloads = []
+
+    def download_object_to_path(self, from_path: str, to_path: str) -> None:
+        self.downloads.append(os.path.basename(from_path))
+        shutil.copyfile(os.path.join(self.root, os.path.relpath(from_path, self.local_root)), to_path)
+
+
+def fill(cache, num_entries):
+    keys = [f"key{i}" for i in range(num_entries)]
+    cache.put_many(keys, np.arange(num_entries * 4, dtype=np.float32).reshape(num_entries, 4))
+
+
+def test_download_embedding_cache_keeps_a_local_cache_as_long(tmp_path):
+    fill(EmbeddingCache(tmp_path / "remote", "model"), 2)
+    local = EmbeddingCache(tmp_path / "local", "model")
+    fill(local, 3)
+
+    bucket = FolderBucket(tmp_path / "remote", tmp_path / "local")
+    assert download_embedding_cache(local, bucket) == 2
+
+    assert bucket.downloads == ["index.txt"]
+    assert len(local) == 3
+
+
+def test_download_embedding_cache_replaces_a_shorter_local_cache(tmp_path):
+    fill(EmbeddingCache(tmp_path / "remote", "model"), 3)
+    local = EmbeddingCache(tmp_path / "local", "model")
+    fill(local, 1)
+
+    bucket = FolderBucket(tmp_path / "remote", tmp_path / "local")
+    assert download_embedding_cache(local, bucket) == 3
+
+    assert len(local) == 3
+    np.testing.assert_array_equal(local.get_many(["key2"])["key2"], [8, 9, 10, 11])
+    assert os.listdir(tmp_path / "local") == ["model"]
@@ -0,0 +1,44 @@
+"""
+Tests of the PowerBI JSON to CSV conversion (see flows/json_to_csv.py and check_json_to_csv.py).
+"""
+import json
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "flows"))
+sys.path.insert(0, ROOT)
+
+from check_json_to_csv import check, random_payload
+from json_to_csv import extract
+
+# Power BI responses of a query paged with restart tokens (2 pages)
+PAGES_PATH = os.path.join(ROOT, "tests", "data", "powerbi_dsr_pages.json")
+
+
+def load_pages():
+    with open(PAGES_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_extract_writes_the_baseline_csv_of_the_recorded_pages():
+    for i, payload in enumerate(load_pages()):
+        check(f"Page {i}", payload)
+
+
+def test_extract_writes_the_baseline_csv_of_random_payloads():
+    rng = random.Random(0)
+    for n in range(300):
+        check(f"Payload {n}", random_payload(rng, rng.randint(1, 30)), loc_append=False)
+
+
+def test_extract_decodes_the_bitsets_and_the_dictionaries():
+    data = extract(load_pages()[0])
+
+    assert list(data.columns) == ["Type", "Entity Name", "Location", "Record ID", "Process description"]
+    assert data.values.tolist() == [
+        ["Government", "Ministry of Digital Affairs", "Kenya", 1001, "Online consultationand workshops"],
+        ["Government", "Digital Agency", "France", 1002, "Public call for inputs"],
+        ["Government", "Civic Tech Group", "France", 1003, None],
+    ]
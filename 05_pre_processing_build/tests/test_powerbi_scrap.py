@@ -0,0 +1,101 @@
+"""
+Tests of the paged Power BI queries and of their offline replay (see flows/etl_powerbi_scrap.py).
+"""
+import copy
+import json
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "flows"))
+
+from etl_cache import ResponseCache
+from etl_powerbi_scrap import query_all_pages
+
+# Power BI responses of a query paged with restart tokens (2 pages)
+PAGES_PATH = os.path.join(ROOT, "tests", "data", "powerbi_dsr_pages.json")
+
+API_URL = "https://powerbi.test/public/reports/querydata?synchronous=true"
+PAYLOAD = {
+    "queries": [
+        {
+            "Query": {
+                "Commands": [
+                    {"SemanticQueryDataShapeCommand": {"Binding": {"DataReduction": {}}}}
+                ]
+            }
+        }
+    ]
+}
+
+
+class RecordedResponse:
+    def __init__(self, result) -> None:
+        self.result = result
+
+    def raise_for_status(self) -> None:
+        pass
+
+    def json(self):
+        return copy.deepcopy(self.result)
+
+
+class ReplaySession:
+    """
+    Answers the queries with the recorded pages, in order, and keeps the payloads it received.
+    """
+
+    def __init__(self, pages) -> None:
+        self.pages = list(pages)
+        self.payloads = []
+
+    def post(self, url, json=None, headers=None):
+        self.payloads.append(copy.deepcopy(json))
+        return RecordedResponse(self.pages.pop(0))
+
+
+class OfflineSession:
+    def post(self, url, json=None, headers=None):
+        raise AssertionError("The offline replay sent a request")
+
+
+def load_pages():
+    with open(PAGES_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_query_all_pages_replays_the_recorded_pages_offline(tmp_path):
+    pages = load_pages()
+
+    # Record the pages in the cache, following the restart tokens
+    session = ReplaySession(pages)
+    cache = ResponseCache(tmp_path, ttl=3600)
+    recorded = query_all_pages(API_URL, PAYLOAD, {}, 3, session=session, cache=cache)
+
+    windows = [
+        payload["queries"][0]["Query"]["Commands"][0]["SemanticQueryDataShapeCommand"][
+            "Binding"
+        ]["DataReduction"]["Primary"]["Window"]
+        for payload in session.payloads
+    ]
+    restart_tokens = pages[0]["results"][0]["result"]["data"]["dsr"]["DS"][0]["RT"]
+    assert windows == [{"Count": 3}, {"Count": 3, "RestartTokens": restart_tokens}]
+    assert recorded["Record ID"].tolist() == [1001, 1002, 1003, 1004, 1005]
+
+    # Replay them without any network access
+    offline_cache = ResponseCache(tmp_path, offline=True)
+    replayed = query_all_pages(
+        API_URL, PAYLOAD, {}, 3, session=OfflineSession(), cache=offline_cache
+    )
+
+    pd.testing.assert_frame_equal(replayed, recorded)
+
+
+def test_query_all_pages_fails_offline_without_recorded_response(tmp_path):
+    offline_cache = ResponseCache(tmp_path, offline=True)
+
+    with pytest.raises(Exception, match="offline mode"):
+        query_all_pages(API_URL, PAYLOAD, {}, 3, session=OfflineSession(), cache=offline_cache)